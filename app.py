@@ -1,13 +1,44 @@
-from flask import Flask, render_template, request, session, redirect, jsonify, url_for
+from flask import Flask, Request, render_template, request, session, redirect, jsonify, url_for, Response, g
 import os
 from PIL import Image, ImageEnhance, ImageFilter
 import pytesseract
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+from spotipy.exceptions import SpotifyException
+from spotipy.cache_handler import MemoryCacheHandler
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import secrets
+from werkzeug.exceptions import RequestEntityTooLarge
 import re
 from dotenv import load_dotenv
 import time
+import threading
+import bisect
+from contextlib import contextmanager
+
+# numpy is optional, it is only needed for PREPROCESS_BACKEND=numpy
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# tesserocr is optional, it keeps tesseract loaded instead of starting the program for every image
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+import multiprocessing
+import queue
+import json
+import sqlite3
+import hashlib
+import io
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 # loading the env variables
 load_dotenv()
@@ -20,6 +51,82 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 # make the folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# limits for uploads
+# images up to UPLOAD_SPOOL_THRESHOLD bytes stay in memory, bigger ones go to a temp file
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv('UPLOAD_SPOOL_THRESHOLD', 8 * 1024 * 1024))
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 50 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 40000000))
+# leave some room for the rest of the form
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 1024 * 1024
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+UPLOAD_TOO_BIG_ERROR = "The images are too big, please upload fewer or smaller screenshots."
+
+# an uploaded file, kept in memory up to max_size bytes and then moved to a temp file
+# in the upload folder, detach() hands the buffer or the file over without copying it
+class UploadSpool:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.file = io.BytesIO()
+        self.path = None
+
+    def write(self, data):
+        if self.path is None and self.file.tell() + len(data) > self.max_size:
+            self.roll_over()
+        return self.file.write(data)
+
+    def roll_over(self):
+        # unique name so two users uploading "Screenshot.png" don't clash
+        fd, path = tempfile.mkstemp(prefix='upload_', dir=app.config['UPLOAD_FOLDER'])
+        file = os.fdopen(fd, 'w+b')
+        with self.file.getbuffer() as data:
+            file.write(data)
+        self.file, self.path = file, path
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    # the data of the upload: the memory buffer, or the temp file path after a roll over
+    # (the request closes its files when it ends, a background job may still need the data)
+    def detach(self):
+        if self.path is None:
+            source = self.file
+            source.seek(0)
+        else:
+            self.file.close()
+            source = self.path
+        self.file = io.BytesIO()
+        self.path = None
+        return source
+
+    def close(self):
+        self.file.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+# werkzeug writes every uploaded file over 500KB to a temp file,
+# keep them in memory up to UPLOAD_SPOOL_THRESHOLD instead
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool(UPLOAD_SPOOL_THRESHOLD)
+
+app.request_class = UploadRequest
+
 # getting spotify keys from env file
 SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
@@ -44,54 +151,948 @@ RE_TIMESTAMP = re.compile(r'\d{1,2}:\d{2}')
 RE_WHITESPACE = re.compile(r'\s+')
 RE_ARTIST_SEPARATORS = [' - ', ' – ', ' by ', ' | ', ' feat. ', ' feat ', ' ft. ', ' ft ', ' & ']
 
+# settings for preprocessing and tesseract
+# (these are part of the ocr cache version, so changing them empties the cache)
+PREPROCESS_MIN_WIDTH = 1000
+PREPROCESS_CONTRAST = 2.0
+PREPROCESS_SHARPNESS = 2.0
+TESSERACT_PSM = 6
+TESSERACT_FALLBACK_PSM = 3
+TESSERACT_CONFIG = f'--oem 3 --psm {TESSERACT_PSM}'
+# "auto" uses tesserocr when it is installed, or force "tesserocr" / "pytesseract"
+OCR_BACKEND = os.getenv('OCR_BACKEND', 'auto')
+TESSDATA_PATH = os.getenv('TESSDATA_PATH')
+TESSERACT_LANG = 'eng'
+# "1" reads word boxes in one tesseract pass and pairs titles and artists by position
+OCR_LAYOUT = os.getenv('OCR_LAYOUT') == '1'
+OCR_MIN_WORD_CONF = 40
+OCR_MIN_LINE_CONF = 60
+# "1" finds the overlap between screenshots taken while scrolling and only reads the new part
+STITCH_SCREENSHOTS = os.getenv('STITCH_SCREENSHOTS') == '1'
+STITCH_SIGNATURE_WIDTH = 32
+STITCH_MIN_ROWS = 10
+STITCH_MARGIN = 0.1
+# "standard" upscales small images, "adaptive" scales by text height and only keeps text lines
+PREPROCESS_MODE = os.getenv('PREPROCESS_MODE', 'standard')
+TARGET_TEXT_HEIGHT = 20
+ROI_STRIPS = 8
+ROI_EDGE_THRESHOLD = 8
+# "pil" uses ImageEnhance, "numpy" does contrast and sharpening in one pass over the image
+PREPROCESS_BACKEND = os.getenv('PREPROCESS_BACKEND', 'pil')
+# turn the image into black text on white (numpy backend only)
+PREPROCESS_BINARIZE = os.getenv('PREPROCESS_BINARIZE') == '1'
+BINARIZE_WINDOW = 31
+BINARIZE_OFFSET = 10
+# the numpy backend works on this many rows at a time, so its arrays stay small
+PREPROCESS_BAND_ROWS = 64
+OCR_MIN_TEXT_LENGTH = 10
+
+# settings for the ocr cache (times are in seconds)
+# OCR_CACHE_DB is an optional sqlite file shared by all workers
+OCR_CACHE_SIZE = int(os.getenv('OCR_CACHE_SIZE', 500))
+OCR_CACHE_TTL = int(os.getenv('OCR_CACHE_TTL', 30 * 24 * 3600))
+OCR_CACHE_DB = os.getenv('OCR_CACHE_DB')
+
+# settings for running ocr on a process pool
+# OCR_WORKERS is the size of the pool, every web worker process has its own pool,
+# so by default the cores are split between the web workers (WEB_CONCURRENCY is the
+# number of web workers, gunicorn reads it too)
+# OCR_MAX_PER_REQUEST is how many images of one request can be in the pool at the same time
+WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+OCR_MAX_PER_REQUEST = max(1, int(os.getenv('OCR_MAX_PER_REQUEST', 4)))
+
+ocr_pool = None
+ocr_pool_lock = threading.Lock()
+
+# settings for spotify searches
+# SEARCH_WORKERS is how many songs of one request are looked up at the same time,
+# SEARCH_MAX_RETRIES is how often a search is tried again after a 429
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', 8))
+SEARCH_MAX_RETRIES = int(os.getenv('SEARCH_MAX_RETRIES', 3))
+
+# settings for the shared spotify client
+# SPOTIFY_RATE_LIMIT is requests per second for all workers together (0 turns it off,
+# spotify has no fixed limit, a 429 still pauses the searches of a worker)
+SPOTIFY_POOL_SIZE = int(os.getenv('SPOTIFY_POOL_SIZE', 20))
+SPOTIFY_TIMEOUT = int(os.getenv('SPOTIFY_TIMEOUT', 10))
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', 0))
+SPOTIFY_BURST = float(os.getenv('SPOTIFY_BURST', 20))
+SPOTIFY_BUDGET_DB = os.getenv('SPOTIFY_BUDGET_DB',
+                              os.path.join(tempfile.gettempdir(), 'spotify_budget.sqlite3'))
+
+# settings for adding songs to playlists (times are in seconds)
+PLAYLIST_STATE_TTL = int(os.getenv('PLAYLIST_STATE_TTL', 300))
+PLAYLIST_BATCH_SIZE = 100
+PLAYLIST_ADD_TIMEOUT = 60
+# the playlist made for a spotify user is kept here for PLAYLIST_STATE_TTL, so clicks that
+# come in before the browser knows it (on any worker) add to it instead of making another one
+PLAYLIST_DB = os.getenv('PLAYLIST_DB', os.path.join(tempfile.gettempdir(), 'extracted_playlists.sqlite3'))
+PLAYLIST_CREATE_TIMEOUT = 30
+PLAYLIST_POLL_INTERVAL = 0.1
+
+# settings for the track cache (times are in seconds)
+# TRACK_CACHE_DB is an optional sqlite file shared by all workers
+TRACK_CACHE_SIZE = int(os.getenv('TRACK_CACHE_SIZE', 5000))
+TRACK_CACHE_TTL = int(os.getenv('TRACK_CACHE_TTL', 7 * 24 * 3600))
+TRACK_CACHE_MISS_TTL = int(os.getenv('TRACK_CACHE_MISS_TTL', 6 * 3600))
+TRACK_CACHE_DB = os.getenv('TRACK_CACHE_DB')
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 24 * 3600))
+
+# settings for background extraction jobs (times are in seconds)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_TTL = int(os.getenv('JOB_TTL', 3600))
+JOB_KEEPALIVE = 15
+# job progress is kept in sqlite, so every worker process can answer for every job
+JOB_DB = os.getenv('JOB_DB', os.path.join(tempfile.gettempdir(), 'extraction_jobs.sqlite3'))
+JOB_POLL_INTERVAL = 0.5
+# "poll" (default) or "sse": with sse the songs page keeps a connection open for the whole job,
+# only use it with async or threaded workers
+JOB_EVENTS = os.getenv('JOB_EVENTS', 'poll')
+
+# settings for metrics
+# SERVER_TIMING=1 adds a Server-Timing header with the time spent in every stage,
+# LOG_TIMINGS=1 prints the same numbers as one json line per request or job
+SERVER_TIMING = os.getenv('SERVER_TIMING') == '1'
+LOG_TIMINGS = os.getenv('LOG_TIMINGS') == '1'
+METRICS_PREFIX = 'playlist_exporter_'
+# histogram buckets in seconds
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_HELP = {
+    'stage_seconds': ('histogram', 'Time spent in each pipeline stage'),
+    'http_request_seconds': ('histogram', 'Time to answer a request, by endpoint'),
+    'spotify_request_seconds': ('histogram', 'Time of Spotify API calls, by endpoint'),
+    'spotify_responses_total': ('counter', 'Spotify API answers by endpoint and status code'),
+    'ocr_images_total': ('counter', 'Images read with Tesseract'),
+    'ocr_fallbacks_total': ('counter', 'Images read a second time because the first pass found too little text'),
+    'search_strategy_hits_total': ('counter', 'Songs found on Spotify, by the search that found them'),
+    'songs_total': ('counter', 'Looked up songs, by result and where the answer came from'),
+    'jobs_total': ('counter', 'Finished extraction jobs, by status'),
+    'errors_total': ('counter', 'Errors, by pipeline stage'),
+}
+
+# counters and timing histograms of this process for /metrics
+# labels are a sorted tuple of (name, value) pairs
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        # first bucket the value fits in, the last one is +Inf
+        bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    # copies, so /metrics doesn't hold the lock while it formats
+    def snapshot(self):
+        with self.lock:
+            return (dict(self.counters),
+                    {key: (list(buckets), total, count)
+                     for key, (buckets, total, count) in self.histograms.items()})
+
+metrics = Metrics()
+
+# time per stage of one request or job, for the Server-Timing header and the log line
+class StageTimings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + 1)
+
+    # stages that ran at the same time (ocr workers, searches) are added up
+    def header(self):
+        with self.lock:
+            return ', '.join(f"{stage};dur={total * 1000:.1f}" for stage, (total, _) in self.stages.items())
+
+    def as_dict(self):
+        with self.lock:
+            return {stage: {'ms': round(total * 1000, 1), 'count': count}
+                    for stage, (total, count) in self.stages.items()}
+
+# per thread: "timings" is the StageTimings of the running request or job (None if off),
+# "collected" is set in ocr workers, their numbers go back to the web process with the result
+metrics_local = threading.local()
+
+def record_stage(stage, seconds):
+    collected = getattr(metrics_local, 'collected', None)
+    if collected is not None:
+        collected.append(('stage', stage, seconds, ()))
+        return
+    metrics.observe('stage_seconds', seconds, (('stage', stage),))
+    timings = getattr(metrics_local, 'timings', None)
+    if timings is not None:
+        timings.add(stage, seconds)
+
+# with timed_stage('ocr'): ... records how long the block took
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def count_metric(name, amount=1, **labels):
+    labels = tuple(sorted(labels.items()))
+    collected = getattr(metrics_local, 'collected', None)
+    if collected is not None:
+        collected.append(('count', name, amount, labels))
+        return
+    metrics.inc(name, amount, labels)
+
+# add the numbers an ocr worker sent back
+def record_collected(collected):
+    for kind, name, value, labels in collected:
+        if kind == 'stage':
+            record_stage(name, value)
+        else:
+            metrics.inc(name, value, labels)
+
+# open an uploaded image, it is either bytes in memory or a temp file path
+def open_image(image_source):
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(image_source))
+    if isinstance(image_source, io.BytesIO):
+        # uploads are decoded straight from the request buffer
+        image_source.seek(0)
+    return Image.open(image_source)
+
+# find the rows of an image that have text, with a projection profile of the edges
+# returns (bands, text_height), bands is a list of (top, bottom)
+def find_text_bands(image):
+    width, height = image.size
+
+    # edges are enough to find text, so work on a narrower copy
+    if width > 1000:
+        image = image.resize((1000, height), Image.Resampling.BOX)
+        width = 1000
+    edges = image.filter(ImageFilter.FIND_EDGES)
+
+    # look at the image in vertical strips, so album art next to the
+    # title and artist doesn't join them into one tall band
+    strip_bands = []
+    strip_width = max(1, width // ROI_STRIPS)
+    for left in range(0, width - strip_width + 1, strip_width):
+        strip = edges.crop((left, 0, left + strip_width, height))
+        profile = strip.resize((1, height), Image.Resampling.BOX).tobytes()
+
+        top = None
+        for y, value in enumerate(profile):
+            if value >= ROI_EDGE_THRESHOLD:
+                if top is None:
+                    top = y
+            elif top is not None:
+                strip_bands.append((top, y))
+                top = None
+        if top is not None:
+            strip_bands.append((top, height))
+
+    # most bands are lines of text, so the median is the text height
+    heights = sorted(bottom - top for top, bottom in strip_bands if bottom - top >= 4)
+    if not heights:
+        return [], 0
+    text_height = heights[len(heights) // 2]
+
+    # keep bands that look like a line of text (no art, icons or big headers)
+    bands = sorted((top, bottom) for top, bottom in strip_bands
+                   if text_height * 0.5 <= bottom - top <= text_height * 2)
+
+    # join bands from different strips that overlap
+    merged = []
+    for top, bottom in bands:
+        if merged and top <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], bottom))
+        else:
+            merged.append((top, bottom))
+    return merged, text_height
+
+# cut out the text lines, stack them and scale them to TARGET_TEXT_HEIGHT
+# returns None when no text lines are found, then the whole image is used
+def crop_text_lines(image):
+    bands, text_height = find_text_bands(image)
+    if len(bands) < 2:
+        return None
+
+    width, height = image.size
+    pad = max(2, text_height // 3)
+    gap = max(4, text_height // 2)
+
+    # add some room around every line so letters are not cut off
+    padded = []
+    for top, bottom in bands:
+        top, bottom = max(0, top - pad), min(height, bottom + pad)
+        if padded and top <= padded[-1][1]:
+            padded[-1] = (padded[-1][0], bottom)
+        else:
+            padded.append((top, bottom))
+
+    # fill the gaps with the background color (the most common gray)
+    histogram = image.histogram()
+    background = histogram.index(max(histogram))
+
+    lines_height = sum(bottom - top for top, bottom in padded) + gap * (len(padded) + 1)
+    lines = Image.new('L', (width, lines_height), background)
+    y = gap
+    for top, bottom in padded:
+        lines.paste(image.crop((0, top, width, bottom)), (0, y))
+        y += bottom - top + gap
+
+    # scale up or down so the text is the size tesseract reads best
+    scale = min(4.0, max(0.35, TARGET_TEXT_HEIGHT / text_height))
+    if abs(scale - 1) > 0.1:
+        new_size = (max(1, int(width * scale)), max(1, int(lines_height * scale)))
+        lines = lines.resize(new_size, Image.Resampling.LANCZOS)
+    return lines
+
+# the preprocessing backend that will really be used (PREPROCESS_BACKEND if none is given)
+def get_preprocess_backend(backend=None):
+    if (backend or PREPROCESS_BACKEND) == 'numpy' and np is not None:
+        return 'numpy'
+    return 'pil'
+
+# band buffers of the numpy backend, kept per thread and reused for every image
+# (they are PREPROCESS_BAND_ROWS rows high and only grow for wider images)
+preprocess_buffers = threading.local()
+
+def get_preprocess_buffer(name, rows, columns, dtype=None):
+    buffer = getattr(preprocess_buffers, name, None)
+    if buffer is None or buffer.size < rows * columns:
+        buffer = np.empty(rows * columns, dtype=dtype or np.int16)
+        setattr(preprocess_buffers, name, buffer)
+    return buffer[:rows * columns].reshape(rows, columns)
+
+# some rows of an image as a uint8 array, without copying the whole image to numpy
+def image_rows(image, top, bottom):
+    return np.asarray(image.crop((0, top, image.width, bottom)))
+
+# blends with a small whole number factor are exact in int16, others need floats
+def is_small_integer(factor):
+    return float(factor).is_integer() and 0 <= factor <= 64
+
+# contrast for some rows: move every pixel away from the mean gray (like Image.blend,
+# it truncates), the result is written to work (int16)
+def enhance_contrast_band(pixels, mean, work):
+    if is_small_integer(PREPROCESS_CONTRAST):
+        # mean + factor * (pixel - mean) = factor * pixel - (factor - 1) * mean
+        np.copyto(work, pixels)
+        work *= int(PREPROCESS_CONTRAST)
+        work -= (int(PREPROCESS_CONTRAST) - 1) * mean
+    else:
+        values = get_preprocess_buffer('float', *work.shape, dtype=np.float32)
+        np.copyto(values, pixels)
+        values -= mean
+        values *= PREPROCESS_CONTRAST
+        values += mean
+        np.clip(values, 0, 255, out=values)
+        np.copyto(work, values, casting='unsafe')
+    np.clip(work, 0, 255, out=work)
+
+# same result as ImageEnhance.Contrast + ImageEnhance.Sharpness, done one band of rows
+# at a time in the per thread int16 buffers instead of making a new image for every step
+def enhance_image_numpy(image):
+    width, height = image.size
+    band = PREPROCESS_BAND_ROWS
+    total = 0
+    for y0 in range(0, height, band):
+        total += int(image_rows(image, y0, min(height, y0 + band)).sum())
+    mean = int(total / (width * height) + 0.5)
+    result = np.empty((height, width), dtype=np.uint8)
+
+    contrast = get_preprocess_buffer('contrast', band + 2, width)
+    # sharpness: move every pixel away from PIL's SMOOTH filter of the image
+    # (3x3 kernel, 5 in the middle and 1 around it, the border is copied)
+    sharpen = height > 2 and width > 2
+    if sharpen:
+        rows = get_preprocess_buffer('rows', band + 2, width - 2)
+        smooth = get_preprocess_buffer('smooth', band, width - 2)
+        sharp = get_preprocess_buffer('sharp', band, width - 2)
+
+    for y0 in range(0, height, band):
+        y1 = min(height, y0 + band)
+        # one more row above and below for the 3x3 window
+        top, bottom = max(0, y0 - 1), min(height, y1 + 1)
+        work = contrast[:bottom - top]
+        enhance_contrast_band(image_rows(image, top, bottom), mean, work)
+        result[y0:y1] = work[y0 - top:y1 - top]
+
+        first, last = max(y0, 1), min(y1, height - 1)
+        if not sharpen or first >= last:
+            continue
+        count = last - first
+        window = work[first - 1 - top:last + 1 - top]
+        center = window[1:-1, 1:-1]
+
+        # 3x3 sum as a row sum and then a column sum, plus 4 more of the middle pixel
+        row_sums = rows[:count + 2]
+        np.add(window[:, :-2], window[:, 1:-1], out=row_sums)
+        row_sums += window[:, 2:]
+        band_smooth = smooth[:count]
+        np.add(row_sums[:-2], row_sums[1:-1], out=band_smooth)
+        band_smooth += row_sums[2:]
+        band_sharp = sharp[:count]
+        np.left_shift(center, 2, out=band_sharp)
+        band_smooth += band_sharp
+
+        # rounded sum / 13 (there are no ties)
+        band_smooth += 6
+        np.floor_divide(band_smooth, 13, out=band_smooth)
+
+        # blend with factor PREPROCESS_SHARPNESS: smooth + factor * (pixel - smooth)
+        if is_small_integer(PREPROCESS_SHARPNESS):
+            np.multiply(center, int(PREPROCESS_SHARPNESS), out=band_sharp)
+            band_smooth *= int(PREPROCESS_SHARPNESS) - 1
+            band_sharp -= band_smooth
+        else:
+            values = get_preprocess_buffer('float', count, width - 2, dtype=np.float32)
+            np.subtract(center, band_smooth, out=band_sharp)
+            np.copyto(values, band_sharp)
+            values *= PREPROCESS_SHARPNESS
+            values += band_smooth
+            np.clip(values, 0, 255, out=values)
+            np.copyto(band_sharp, values, casting='unsafe')
+        np.clip(band_sharp, 0, 255, out=band_sharp)
+        result[first:last, 1:-1] = band_sharp
+
+    if PREPROCESS_BINARIZE:
+        return Image.fromarray(binarize_numpy(result))
+    return Image.fromarray(result)
+
+# adaptive threshold: compare every pixel with the mean of the window around it
+# the result is always dark text on white, also for dark mode screenshots
+# the window sums are running sums over one band of rows at a time, in int32
+def binarize_numpy(pixels):
+    height, width = pixels.shape
+    half = BINARIZE_WINDOW // 2
+    window = 2 * half + 1
+    band = PREPROCESS_BAND_ROWS
+    # dark mode has light text, so text is brighter than the area around it
+    dark_mode = pixels.mean() < 128
+    result = np.empty((height, width), dtype=np.uint8)
+
+    # how many pixels of a window are inside the image, for every column
+    x = np.arange(width)
+    columns = (np.minimum(width, x + half + 1) - np.maximum(0, x - half)).astype(np.int32)
+
+    # the rows of a band and half a window above and below it (zero outside the image),
+    # after a zero row, so the running sum gives the sum of any run of rows
+    rows = np.empty((band + window, width), dtype=np.int32)
+    # the same for the columns of the window sums
+    sums = np.empty((band, width + window), dtype=np.int32)
+    window_sum = np.empty((band, width), dtype=np.int32)
+    window_size = np.empty((band, width), dtype=np.int32)
+    scaled = np.empty((band, width), dtype=np.int32)
+    text = np.empty((band, width), dtype=bool)
+
+    for y0 in range(0, height, band):
+        y1 = min(height, y0 + band)
+        count = y1 - y0
+        first, last = max(0, y0 - half), min(height, y1 + half)
+
+        # sum of the window rows for every row of the band, per column
+        padded = rows[:count + window]
+        start = 1 + first - (y0 - half)
+        padded[:start] = 0
+        padded[start:start + last - first] = pixels[first:last]
+        padded[start + last - first:] = 0
+        np.cumsum(padded, axis=0, out=padded)
+        column_sums = sums[:count]
+        column_sums[:, :half + 1] = 0
+        np.subtract(padded[window:], padded[:count], out=column_sums[:, half + 1:half + 1 + width])
+        column_sums[:, half + 1 + width:] = 0
+
+        # and then of the window columns for every pixel
+        np.cumsum(column_sums, axis=1, out=column_sums)
+        band_sum = window_sum[:count]
+        np.subtract(column_sums[:, window:], column_sums[:, :width], out=band_sum)
+
+        y = np.arange(y0, y1)
+        row_counts = (np.minimum(height, y + half + 1) - np.maximum(0, y - half)).astype(np.int32)
+        band_size = window_size[:count]
+        np.multiply(row_counts[:, None], columns, out=band_size)
+
+        # pixel < sum / size - offset is pixel * size < sum - offset * size, without division
+        band_pixels = scaled[:count]
+        np.multiply(pixels[y0:y1], band_size, out=band_pixels)
+        band_size *= BINARIZE_OFFSET
+        band_text = text[:count]
+        if dark_mode:
+            band_sum += band_size
+            np.greater(band_pixels, band_sum, out=band_text)
+        else:
+            band_sum -= band_size
+            np.less(band_pixels, band_sum, out=band_text)
+
+        band_result = result[y0:y1]
+        band_result.fill(255)
+        np.copyto(band_result, 0, where=band_text)
+    return result
+
 # function to make image better for reading
-def preprocess_image(image_path):
+# crop_top skips the rows that were already read in the previous screenshot
+# backend is 'pil' or 'numpy', PREPROCESS_BACKEND is used when it is not given
+def preprocess_image(image_source, crop_top=0, backend=None):
     try:
-        image = Image.open(image_path)
-        
-        # change to black and white
-        image = image.convert('L')
+        # change to black and white (the image is decoded here)
+        with timed_stage('decode'):
+            image = open_image(image_source)
+            image = image.convert('L')
         
-        # make image bigger if it's too small
-        width, height = image.size
-        if width < 1000:
-            scale_factor = 1000 / width
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # make contrast better
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(2.0)
-        
-        # make it sharper
-        enhancer = ImageEnhance.Sharpness(image)
-        image = enhancer.enhance(2.0)
+        with timed_stage('preprocess'):
+            if crop_top:
+                image = image.crop((0, crop_top, image.width, image.height))
+            
+            # only keep the text lines, at the size tesseract reads best
+            text_lines = crop_text_lines(image) if PREPROCESS_MODE == 'adaptive' else None
+            if text_lines is not None:
+                image = text_lines
+            
+            # make image bigger if it's too small
+            width, height = image.size
+            if text_lines is None and width < PREPROCESS_MIN_WIDTH:
+                scale_factor = PREPROCESS_MIN_WIDTH / width
+                new_width = int(width * scale_factor)
+                new_height = int(height * scale_factor)
+                image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            
+            if get_preprocess_backend(backend) == 'numpy':
+                return enhance_image_numpy(image)
+            
+            # make contrast better
+            enhancer = ImageEnhance.Contrast(image)
+            image = enhancer.enhance(PREPROCESS_CONTRAST)
+            
+            # make it sharper
+            enhancer = ImageEnhance.Sharpness(image)
+            image = enhancer.enhance(PREPROCESS_SHARPNESS)
         
         return image
     except Exception as e:
+        count_metric('errors_total', stage='preprocess')
         print(f"Error preprocessing image: {e}")
         return None
 
 # function to get text from image
-def extract_text_optimized(image_path):
-    image = preprocess_image(image_path)
+def extract_text_optimized(image_source, crop_top=0):
+    image = preprocess_image(image_source, crop_top)
     if not image:
         return ""
     
     # try to read text with tesseract
+    count_metric('ocr_images_total')
     try:
-        text = pytesseract.image_to_string(image, config='--oem 3 --psm 6')
+        with timed_stage('ocr'):
+            text = ocr_image_to_string(image, TESSERACT_PSM)
         
         # if text is too short, try again with default settings
-        if len(text.strip()) < 10:
-            text = pytesseract.image_to_string(image)
+        if len(text.strip()) < OCR_MIN_TEXT_LENGTH:
+            count_metric('ocr_fallbacks_total')
+            with timed_stage('ocr_fallback'):
+                text = ocr_image_to_string(image, TESSERACT_FALLBACK_PSM)
             
         return text
     except Exception as e:
+        count_metric('errors_total', stage='ocr')
         print(f"OCR Error: {e}")
         return ""
 
+# ready tesseract engines of this process, an engine is only used by one thread at a time
+tesseract_engines = queue.LifoQueue()
+tesserocr_failed = False
+
+# the ocr backend that will really be used
+def get_ocr_backend():
+    if OCR_BACKEND == 'pytesseract' or tesserocr is None or tesserocr_failed:
+        return 'pytesseract'
+    return 'tesserocr'
+
+# load a new tesseract engine (this reads the language model once)
+def create_tesseract_engine():
+    options = {'lang': TESSERACT_LANG, 'oem': tesserocr.OEM.DEFAULT}
+    if TESSDATA_PATH:
+        options['path'] = TESSDATA_PATH
+    return tesserocr.PyTessBaseAPI(**options)
+
+# take a ready engine or load a new one, returns None if tesserocr can't be used
+def acquire_tesseract_engine():
+    global tesserocr_failed
+    try:
+        return tesseract_engines.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        return create_tesseract_engine()
+    except RuntimeError as e:
+        # no language data for the bindings, use the tesseract program instead
+        print(f"tesserocr error, using pytesseract: {e}")
+        tesserocr_failed = True
+        return None
+
+def release_tesseract_engine(api):
+    api.Clear()
+    tesseract_engines.put(api)
+
+# read the text of a PIL image with the given page segmentation mode
+def ocr_image_to_string(image, psm):
+    api = acquire_tesseract_engine() if get_ocr_backend() == 'tesserocr' else None
+    if api is not None:
+        try:
+            # the image is passed in memory, no temp files
+            api.SetPageSegMode(psm)
+            api.SetImage(image)
+            return api.GetUTF8Text()
+        finally:
+            release_tesseract_engine(api)
+
+    if psm == TESSERACT_PSM:
+        return pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
+    return pytesseract.image_to_string(image, config=f'--psm {psm}')
+
+# read every word of a PIL image with its box and confidence
+# returns a list of dicts with text, conf, left, top, width, height and line
+def ocr_image_to_words(image, psm):
+    words = []
+    api = acquire_tesseract_engine() if get_ocr_backend() == 'tesserocr' else None
+    if api is not None:
+        try:
+            api.SetPageSegMode(psm)
+            api.SetImage(image)
+            api.Recognize()
+            iterator = api.GetIterator()
+            level = tesserocr.RIL.WORD
+            line = -1
+            while iterator is not None:
+                if iterator.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                    line += 1
+                text = iterator.GetUTF8Text(level)
+                box = iterator.BoundingBox(level)
+                if text and box:
+                    left, top, right, bottom = box
+                    words.append({'text': text, 'conf': iterator.Confidence(level),
+                                  'left': left, 'top': top, 'width': right - left,
+                                  'height': bottom - top, 'line': line})
+                if not iterator.Next(level):
+                    break
+            return words
+        finally:
+            release_tesseract_engine(api)
+
+    data = pytesseract.image_to_data(image, config=f'--oem 3 --psm {psm}',
+                                     output_type=pytesseract.Output.DICT)
+    for i, text in enumerate(data['text']):
+        if data['level'][i] == 5 and text.strip():
+            words.append({'text': text, 'conf': float(data['conf'][i]),
+                          'left': data['left'][i], 'top': data['top'][i],
+                          'width': data['width'][i], 'height': data['height'][i],
+                          'line': (data['block_num'][i], data['par_num'][i], data['line_num'][i])})
+    return words
+
+# layout mode: one tesseract pass, songs are found from the word positions
+def extract_songs_from_layout(image_source, crop_top=0):
+    image = preprocess_image(image_source, crop_top)
+    if not image:
+        return []
+
+    count_metric('ocr_images_total')
+    try:
+        with timed_stage('ocr'):
+            words = ocr_image_to_words(image, TESSERACT_PSM)
+    except Exception as e:
+        count_metric('errors_total', stage='ocr')
+        print(f"OCR Error: {e}")
+        return []
+    with timed_stage('parse'):
+        return extract_songs_from_words(words)
+
+# load the engine when a pool worker starts, so the first image doesn't wait for it
+def init_ocr_worker():
+    global tesserocr_failed
+    if get_ocr_backend() == 'tesserocr':
+        try:
+            tesseract_engines.put(create_tesseract_engine())
+        except RuntimeError as e:
+            print(f"tesserocr error, using pytesseract: {e}")
+            tesserocr_failed = True
+
+# get the shared ocr pool, it is made on first use
+def get_ocr_pool():
+    global ocr_pool
+    if OCR_WORKERS <= 1:
+        return None
+
+    with ocr_pool_lock:
+        if ocr_pool is None:
+            # spawn so workers don't inherit locks from the web server threads
+            ocr_pool = ProcessPoolExecutor(max_workers=OCR_WORKERS,
+                                           mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=init_ocr_worker)
+        return ocr_pool
+
+# throw away a broken pool so the next request makes a new one
+def reset_ocr_pool(broken_pool):
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is broken_pool:
+            ocr_pool = None
+    broken_pool.shutdown(wait=False)
+
+# read one image (this runs inside the pool)
+# returns (text or the song pairs in layout mode, timings and counters for record_collected)
+def ocr_image_worker(image_source, crop_top=0):
+    metrics_local.collected = collected = []
+    try:
+        if OCR_LAYOUT:
+            return extract_songs_from_layout(image_source, crop_top), collected
+        return extract_text_optimized(image_source, crop_top), collected
+    finally:
+        metrics_local.collected = None
+
+# version of the ocr cache, changes when preprocessing or tesseract changes
+ocr_cache_version = None
+
+def get_ocr_cache_version():
+    global ocr_cache_version
+    if ocr_cache_version is None:
+        try:
+            if get_ocr_backend() == 'tesserocr':
+                tesseract_version = tesserocr.tesseract_version()
+            else:
+                tesseract_version = str(pytesseract.get_tesseract_version())
+        except Exception:
+            tesseract_version = 'unknown'
+        settings = [PREPROCESS_MIN_WIDTH, PREPROCESS_CONTRAST, PREPROCESS_SHARPNESS,
+                    TESSERACT_CONFIG, OCR_MIN_TEXT_LENGTH, PREPROCESS_MODE,
+                    TARGET_TEXT_HEIGHT, ROI_STRIPS, ROI_EDGE_THRESHOLD, STITCH_MARGIN,
+                    get_preprocess_backend(), PREPROCESS_BINARIZE, BINARIZE_WINDOW,
+                    BINARIZE_OFFSET, OCR_LAYOUT, OCR_MIN_WORD_CONF, OCR_MIN_LINE_CONF,
+                    tesseract_version]
+        ocr_cache_version = hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:12]
+    return ocr_cache_version
+
+# sha256 of the uploaded bytes of an image
+def image_digest(image_source):
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        digest = hashlib.sha256(image_source)
+    elif isinstance(image_source, io.BytesIO):
+        with image_source.getbuffer() as data:
+            digest = hashlib.sha256(data)
+    else:
+        digest = hashlib.sha256()
+        with open(image_source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+# cache key for an image, based on its digest and where the new part starts
+def ocr_cache_key(digest, crop_top=0):
+    return f"{get_ocr_cache_version()}:{digest}:{crop_top}"
+
+# cache key for the new part of every screenshot of a list of screenshots (in upload order)
+def stitch_cache_key(digests):
+    joined = hashlib.sha256(' '.join(digests).encode()).hexdigest()
+    return f"{get_ocr_cache_version()}:stitch:{joined}"
+
+# a small hash of every row of an image, to find the same rows in another screenshot
+# returns (width, height, rows), rows is None for rows with no detail (plain background)
+def image_row_signatures(image_source):
+    image = open_image(image_source).convert('L')
+    width, height = image.size
+    small = image.resize((STITCH_SIGNATURE_WIDTH, height), Image.Resampling.BOX)
+    # 16 gray levels, so small color differences don't matter
+    data = small.point(lambda value: value // 16).tobytes()
+
+    rows = []
+    for y in range(height):
+        row = data[y * STITCH_SIGNATURE_WIDTH:(y + 1) * STITCH_SIGNATURE_WIDTH]
+        rows.append(row if min(row) != max(row) else None)
+    return width, height, rows
+
+# row signatures of one screenshot (this runs inside the pool), None if it can't be read
+def row_signatures_worker(image_source):
+    try:
+        return image_row_signatures(image_source)
+    except Exception as e:
+        print(f"Stitch error: {e}")
+        return None
+
+# row signatures of all screenshots, made in the ocr pool when there is one
+# so the images are decoded at the same time and not in the request thread
+def collect_row_signatures(sources):
+    pool = get_ocr_pool()
+    if pool is not None:
+        signatures = []
+        try:
+            # keep at most OCR_MAX_PER_REQUEST images of this request in the pool
+            for start in range(0, len(sources), OCR_MAX_PER_REQUEST):
+                signatures.extend(pool.map(row_signatures_worker,
+                                           sources[start:start + OCR_MAX_PER_REQUEST]))
+            return signatures
+        except BrokenProcessPool as e:
+            count_metric('errors_total', stage='ocr_pool')
+            print(f"OCR pool error: {e}")
+            reset_ocr_pool(pool)
+    return [row_signatures_worker(source) for source in sources]
+
+# how far the content moved up between two screenshots (None if they don't overlap)
+def find_scroll_offset(previous_rows, rows):
+    positions = {}
+    for y, row in enumerate(previous_rows):
+        if row is not None:
+            positions.setdefault(row, []).append(y)
+
+    # every row that is also in the previous screenshot votes for an offset
+    votes = {}
+    for y, row in enumerate(rows):
+        matches = positions.get(row)
+        # rows that repeat a lot (separators, icons) don't tell us anything
+        if not matches or len(matches) > 8:
+            continue
+        for previous_y in matches:
+            offset = previous_y - y
+            if offset > 0:
+                votes[offset] = votes.get(offset, 0) + 1
+
+    if not votes:
+        return None
+    offset, count = max(votes.items(), key=lambda item: item[1])
+    detailed_rows = sum(1 for row in rows if row is not None)
+    if count < max(STITCH_MIN_ROWS, detailed_rows * 0.05):
+        return None
+    return offset
+
+# for every screenshot, the first row that was not in the one before it
+# (None when the whole screenshot was already in the one before it)
+# signatures come from collect_row_signatures, None for images that could not be read
+def find_new_content_tops(signatures):
+    tops = [0] * len(signatures)
+    previous = None
+    for index, current in enumerate(signatures):
+        if current is None:
+            count_metric('errors_total', stage='stitch')
+            previous = None
+            continue
+
+        # only screenshots from the same screen can overlap
+        if previous is not None and previous[0] == current[0]:
+            offset = find_scroll_offset(previous[2], current[2])
+            if offset is not None:
+                previous_rows, rows = previous[2], current[2]
+                height = current[1]
+                matched = [y for y in range(min(height, len(previous_rows) - offset))
+                           if rows[y] is not None and rows[y] == previous_rows[y + offset]]
+                if offset + height <= len(previous_rows):
+                    tops[index] = None
+                elif matched:
+                    # start a bit higher so a title is not cut from its artist,
+                    # the song that is read twice is dropped by merge_song_pairs
+                    top = max(0, matched[-1] + 1 - int(height * STITCH_MARGIN))
+                    # move up to a plain row, so no text line is cut
+                    while top > 0 and rows[top] is not None:
+                        top -= 1
+                    tops[index] = top
+        previous = current
+    return tops
+
+# run ocr for all images of a request at the same time
+def extract_songs_parallel(sources):
+    texts = [None] * len(sources)
+
+    with timed_stage('ocr_cache'):
+        digests = [image_digest(source) for source in sources]
+
+    # screenshots of one scrolling list: only read what is new in each one
+    crop_tops = [0] * len(sources)
+    if STITCH_SCREENSHOTS and len(sources) > 1:
+        with timed_stage('stitch'):
+            # the same screenshots again, they don't have to be decoded to compare them
+            stitch_key = stitch_cache_key(digests)
+            found, cached_tops = ocr_cache.get(stitch_key)
+            if found:
+                crop_tops = cached_tops
+            else:
+                signatures = collect_row_signatures(sources)
+                crop_tops = find_new_content_tops(signatures)
+                # an image that could not be read can be an error, so don't keep it
+                if None not in signatures:
+                    ocr_cache.set(stitch_key, crop_tops)
+
+    # skip tesseract for images we have read before
+    cache_keys = [ocr_cache_key(digest, crop_top) for digest, crop_top in zip(digests, crop_tops)]
+    for index, key in enumerate(cache_keys):
+        if crop_tops[index] is None:
+            # nothing new in this screenshot
+            texts[index] = ''
+            continue
+        found, text = ocr_cache.get(key)
+        if found:
+            texts[index] = text
+    todo = [index for index in range(len(sources)) if texts[index] is None]
+
+    pool = get_ocr_pool()
+    if pool is not None and len(todo) > 1:
+        pending = {}
+        next_todo = 0
+        try:
+            while next_todo < len(todo) or pending:
+                # keep at most OCR_MAX_PER_REQUEST images of this request in the pool
+                while next_todo < len(todo) and len(pending) < OCR_MAX_PER_REQUEST:
+                    index = todo[next_todo]
+                    future = pool.submit(ocr_image_worker, sources[index], crop_tops[index])
+                    pending[future] = index
+                    next_todo += 1
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    texts[index], collected = future.result()
+                    record_collected(collected)
+        except BrokenProcessPool as e:
+            count_metric('errors_total', stage='ocr_pool')
+            print(f"OCR pool error: {e}")
+            reset_ocr_pool(pool)
+
+    # do the rest here if there is no pool or it broke
+    for index in todo:
+        if texts[index] is None:
+            texts[index], collected = ocr_image_worker(sources[index], crop_tops[index])
+            record_collected(collected)
+        # empty text can be an error, so don't keep it
+        if texts[index]:
+            ocr_cache.set(cache_keys[index], texts[index])
+
+    # layout mode already gives pairs (lists after a trip through the json cache)
+    with timed_stage('parse'):
+        return merge_song_pairs([extract_songs_from_text(result) if isinstance(result, str)
+                                 else [tuple(pair) for pair in result]
+                                 for result in texts])
+
+# join songs from all images in upload order and drop duplicates
+def merge_song_pairs(pair_lists):
+    seen = set()
+    merged = []
+    for pairs in pair_lists:
+        for pair in pairs:
+            if pair not in seen:
+                seen.add(pair)
+                merged.append(pair)
+    return merged
+
 # function to clean up the text
 def clean_spotify_text(text):
     if not text: return ""
@@ -121,6 +1122,18 @@ def is_likely_song_title(text):
         
     return True
 
+# split "song - artist" style lines, returns None if there is no artist in the line
+def split_song_artist(line):
+    for sep in RE_ARTIST_SEPARATORS:
+        if sep in line:
+            parts = line.split(sep, 1)
+            if len(parts) == 2:
+                song = parts[0].strip()
+                artist = parts[1].strip()
+                if len(song) > 1 and len(artist) > 1:
+                    return (song, artist)
+    return None
+
 # main function to find songs in text
 def extract_songs_from_text(text):
     lines = [line.strip() for line in text.split('\n') if line.strip()]
@@ -135,19 +1148,9 @@ def extract_songs_from_text(text):
             continue
             
         # check if artist is in the same line
-        found_separator = False
-        for sep in RE_ARTIST_SEPARATORS:
-            if sep in line:
-                parts = line.split(sep, 1)
-                if len(parts) == 2:
-                    song = parts[0].strip()
-                    artist = parts[1].strip()
-                    if len(song) > 1 and len(artist) > 1:
-                        songs.append((song, artist))
-                        found_separator = True
-                        break
-        
-        if found_separator:
+        pair = split_song_artist(line)
+        if pair:
+            songs.append(pair)
             i += 1
             continue
             
@@ -167,32 +1170,555 @@ def extract_songs_from_text(text):
         
     return songs
 
+# find songs from word boxes: a title has its artist right below it, left aligned
+# and in the same or a smaller font
+def extract_songs_from_words(words):
+    # group the sure words by line
+    lines = {}
+    for word in words:
+        if word['conf'] >= OCR_MIN_WORD_CONF and word['text'].strip():
+            lines.setdefault(word['line'], []).append(word)
+
+    # cut lines into segments at big gaps, so columns (album, time) are separate
+    segments = []
+    for line_words in lines.values():
+        line_words.sort(key=lambda w: w['left'])
+        heights = sorted(w['height'] for w in line_words)
+        max_gap = heights[len(heights) // 2]
+
+        current = [line_words[0]]
+        for word in line_words[1:]:
+            previous = current[-1]
+            if word['left'] - (previous['left'] + previous['width']) > max_gap:
+                segments.append(current)
+                current = []
+            current.append(word)
+        segments.append(current)
+
+    # one entry per segment that looks like a song title or artist
+    entries = []
+    for segment in segments:
+        text = clean_spotify_text(' '.join(w['text'] for w in segment))
+        conf = sum(w['conf'] for w in segment) / len(segment)
+        if conf < OCR_MIN_LINE_CONF or not is_likely_song_title(text):
+            continue
+        entries.append({
+            'text': text,
+            'left': segment[0]['left'],
+            'top': min(w['top'] for w in segment),
+            'bottom': max(w['top'] + w['height'] for w in segment),
+            # tallest word is the best guess for the font size
+            'height': max(w['height'] for w in segment),
+        })
+    entries.sort(key=lambda e: (e['top'], e['left']))
+
+    # pair every title with the artist line below it
+    found = []
+    used = set()
+    for i, title in enumerate(entries):
+        if i in used:
+            continue
+        used.add(i)
+        artist = None
+        for j in range(i + 1, len(entries)):
+            below = entries[j]
+            if below['top'] - title['bottom'] > title['height'] * 1.2:
+                break
+            if (j not in used and below['top'] >= title['bottom'] - title['height'] * 0.3
+                    and -title['height'] * 0.5 <= below['left'] - title['left'] <= title['height'] * 3
+                    and below['height'] <= title['height'] * 1.1):
+                artist = below
+                used.add(j)
+                break
+        found.append((title, artist))
+
+    # titles with an artist show where the track list is, drop lone text in other columns
+    columns = [title['left'] for title, artist in found if artist]
+    songs = []
+    for title, artist in found:
+        if artist:
+            songs.append((title['text'], artist['text']))
+            continue
+        in_track_list = not columns or any(abs(title['left'] - left) <= title['height'] for left in columns)
+        if not in_track_list:
+            continue
+        pair = split_song_artist(title['text'])
+        if pair:
+            songs.append(pair)
+        elif len(title['text']) > 3:
+            songs.append((title['text'], ''))
+    return songs
+
+# sqlite connections of this thread, by (file, table setup, process id)
+sqlite_local = threading.local()
+
+# open a sqlite file in WAL mode and run its "CREATE TABLE" once per connection
+# every thread has its own connections, so threads don't wait for each other,
+# and they are opened again after a fork (connections can't be shared)
+def get_sqlite_db(path, schema, isolation_level=''):
+    connections = getattr(sqlite_local, 'connections', None)
+    if connections is None:
+        connections = sqlite_local.connections = {}
+    key = (path, schema, os.getpid())
+    db = connections.get(key)
+    if db is None:
+        db = sqlite3.connect(path, timeout=5, isolation_level=isolation_level)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(schema)
+        db.commit()
+        connections[key] = db
+    return db
+
+# cache with an lru in memory and an optional sqlite file on disk
+# values are stored as json, so None can be cached too
+class ResultCache:
+    def __init__(self, name, maxsize, ttl, db_path=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db_path = db_path
+        # only for the memory part, sqlite is read and written without it
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def get_db(self):
+        if not self.db_path:
+            return None
+        try:
+            return get_sqlite_db(self.db_path, f'CREATE TABLE IF NOT EXISTS {self.name} '
+                                               '(key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        except sqlite3.Error as e:
+            print(f"Cache error: {e}")
+            return None
+
+    # put an item in memory and drop the oldest ones if it's full
+    def remember(self, key, value, expires):
+        self.items[key] = (value, expires)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    # returns (found, value)
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0]
+                del self.items[key]
+
+        db = self.get_db()
+        if db is not None:
+            try:
+                row = db.execute(f'SELECT value, expires FROM {self.name} WHERE key = ?',
+                                 (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"Cache error: {e}")
+                row = None
+            if row and row[1] > now:
+                value = json.loads(row[0])
+                with self.lock:
+                    self.remember(key, value, row[1])
+                    self.hits += 1
+                return True, value
+
+        with self.lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.remember(key, value, expires)
+            self.writes += 1
+            # clean up expired rows now and then
+            clean_up = self.writes % 500 == 0
+
+        db = self.get_db()
+        if db is None:
+            return
+        try:
+            db.execute(f'INSERT OR REPLACE INTO {self.name} (key, value, expires) VALUES (?, ?, ?)',
+                       (key, json.dumps(value), expires))
+            if clean_up:
+                db.execute(f'DELETE FROM {self.name} WHERE expires < ?', (time.time(),))
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Cache error: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.items)}
+
+track_cache = ResultCache('track_cache', TRACK_CACHE_SIZE, TRACK_CACHE_TTL, TRACK_CACHE_DB)
+search_cache = ResultCache('search_cache', TRACK_CACHE_SIZE, SEARCH_CACHE_TTL, TRACK_CACHE_DB)
+ocr_cache = ResultCache('ocr_cache', OCR_CACHE_SIZE, OCR_CACHE_TTL, OCR_CACHE_DB)
+
+# remove special chars the same way for searching and for cache keys
+def clean_search_text(text):
+    return re.sub(r'[^\w\s]', '', text).strip() if text else ''
+
+# cache key for a song, so "Song!" and "song" by the same artist are the same
+def track_cache_key(song_clean, artist_clean):
+    return f"{song_clean.lower()}|{artist_clean.lower()}"
+
+# numbers about the spotify client, for /stats/spotify
+spotify_stats = {'requests': 0, 'throttled': 0, 'budget_waits': 0,
+                 'budget_wait_seconds': 0.0, 'token_refreshes': 0}
+spotify_stats_lock = threading.Lock()
+
+def count_spotify_stat(name, amount=1):
+    with spotify_stats_lock:
+        spotify_stats[name] += amount
+
+# token bucket for spotify requests, kept in sqlite so all worker processes share it
+class RequestBudget:
+    def __init__(self, db_path, rate, burst):
+        self.db_path = db_path
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+
+    def get_db(self):
+        try:
+            # no automatic transactions, update() starts its own
+            return get_sqlite_db(self.db_path, 'CREATE TABLE IF NOT EXISTS budget '
+                                               '(id INTEGER PRIMARY KEY, tokens REAL, updated REAL)',
+                                 isolation_level=None)
+        except sqlite3.Error as e:
+            print(f"Budget error: {e}")
+            return None
+
+    # change the tokens left, returns how long to wait before the request can go
+    def update(self, take=0, pause=0):
+        with self.lock:
+            db = self.get_db()
+            if db is None:
+                # don't block spotify calls just because the file is broken
+                return 0
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                row = db.execute('SELECT tokens, updated FROM budget WHERE id = 1').fetchone()
+                now = time.time()
+                tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) * self.rate)
+
+                wait = 0
+                if pause:
+                    # spotify said 429: nobody sends anything for "pause" seconds
+                    tokens = min(tokens, -pause * self.rate)
+                elif tokens >= take:
+                    tokens -= take
+                else:
+                    wait = (take - tokens) / self.rate
+
+                db.execute('INSERT OR REPLACE INTO budget (id, tokens, updated) VALUES (1, ?, ?)',
+                           (tokens, now))
+                db.execute('COMMIT')
+                return wait
+            except sqlite3.Error as e:
+                print(f"Budget error: {e}")
+                try:
+                    db.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
+                return 0
+
+    # wait until a request is allowed
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self.update(take=1)
+            if wait <= 0:
+                return
+            count_spotify_stat('budget_waits')
+            count_spotify_stat('budget_wait_seconds', wait)
+            time.sleep(wait)
+
+    # make every worker wait after a 429
+    def pause(self, seconds):
+        if self.rate > 0:
+            self.update(pause=seconds)
+
+spotify_budget = RequestBudget(SPOTIFY_BUDGET_DB, SPOTIFY_RATE_LIMIT, SPOTIFY_BURST)
+
+# one http session for all spotify calls of this process, so connections are kept open
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            # only retry reads on server errors, 429s are handled by the budget and backoff
+            # (urllib3 would also retry and sleep on any answer with a Retry-After header)
+            retry = Retry(total=3, connect=None, read=False, status=3,
+                          allowed_methods=frozenset(['GET']), backoff_factor=0.3,
+                          status_forcelist=(500, 502, 503, 504), raise_on_status=False,
+                          respect_retry_after_header=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SPOTIFY_POOL_SIZE, max_retries=retry)
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+        return http_session
+
+# oauth helper, login and token refresh use the same settings
+def create_spotify_oauth(cache_handler=None):
+    return SpotifyOAuth(
+        SPOTIPY_CLIENT_ID,
+        SPOTIPY_CLIENT_SECRET,
+        SPOTIPY_REDIRECT_URI,
+        scope=SCOPE,
+        cache_handler=cache_handler
+    )
+
+# auth manager for one user's token, refreshes it when it runs out (also in the middle of a batch)
+class TokenInfoAuth:
+    def __init__(self, token_info):
+        self.token_info = dict(token_info)
+        self.refreshed = False
+        self.lock = threading.Lock()
+
+    def get_access_token(self, as_dict=False):
+        with self.lock:
+            if self.token_info.get('refresh_token') and SpotifyOAuth.is_token_expired(self.token_info):
+                # memory cache, so one user's token never ends up in the shared .cache file
+                oauth = create_spotify_oauth(cache_handler=MemoryCacheHandler())
+                self.token_info = oauth.refresh_access_token(self.token_info['refresh_token'])
+                self.refreshed = True
+                count_spotify_stat('token_refreshes')
+            return self.token_info if as_dict else self.token_info['access_token']
+
+# spotify client that uses the shared connection pool and request budget
+class PooledSpotify(spotipy.Spotify):
+    def _internal_call(self, method, url, payload, params):
+        spotify_budget.acquire()
+        count_spotify_stat('requests')
+        start = time.perf_counter()
+        status = '200'
+        try:
+            return super()._internal_call(method, url, payload, params)
+        except SpotifyException as e:
+            status = str(e.http_status)
+            if e.http_status == 429:
+                count_spotify_stat('throttled')
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            endpoint = spotify_endpoint(url)
+            metrics.observe('spotify_request_seconds', time.perf_counter() - start, (('endpoint', endpoint),))
+            count_metric('spotify_responses_total', endpoint=endpoint, status=status)
+
+    # the session is shared, so don't close it when this client goes away
+    def __del__(self):
+        pass
+
+# first part of the api path ("search", "playlists", ...), so metrics don't get a label per id
+def spotify_endpoint(url):
+    path = url.split('?', 1)[0]
+    if '/v1/' in path:
+        path = path.split('/v1/', 1)[1]
+    return path.split('/', 1)[0] or 'unknown'
+
+# spotify client for a token_info dict (used by background jobs)
+def create_spotify_client(token_info):
+    auth = TokenInfoAuth(token_info)
+    sp = PooledSpotify(auth_manager=auth, requests_session=get_http_session(),
+                       requests_timeout=SPOTIFY_TIMEOUT)
+    return sp, auth
+
+# spotify client for the logged in user, a refreshed token is saved after the request
+def get_spotify_client():
+    sp, auth = create_spotify_client(session['token_info'])
+    g.spotify_auth = auth
+    return sp
+
+@app.after_request
+def save_refreshed_token(response):
+    auth = g.get('spotify_auth')
+    if auth is not None and auth.refreshed:
+        session['token_info'] = auth.token_info
+    return response
+
+# start timing the request, stage times are only kept per request if they are shown somewhere
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    metrics_local.timings = StageTimings() if SERVER_TIMING or LOG_TIMINGS else None
+
+@app.after_request
+def record_request_time(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    metrics.observe('http_request_seconds', elapsed, (('endpoint', request.endpoint or 'unknown'),))
+
+    timings = getattr(metrics_local, 'timings', None)
+    if timings is not None:
+        if SERVER_TIMING:
+            stages = timings.header()
+            response.headers['Server-Timing'] = f"total;dur={elapsed * 1000:.1f}" + (f", {stages}" if stages else '')
+        if LOG_TIMINGS:
+            log_timings({'path': request.path, 'status': response.status_code}, elapsed, timings)
+    return response
+
+@app.teardown_request
+def clear_request_timer(error=None):
+    metrics_local.timings = None
+
+# one json line with the time of every stage
+def log_timings(fields, elapsed, timings):
+    print(json.dumps({'event': 'timings', **fields, 'ms': round(elapsed * 1000, 1),
+                      'stages': timings.as_dict()}), flush=True)
+
+# connection pool and throttling numbers
+def spotify_client_stats():
+    with spotify_stats_lock:
+        stats = dict(spotify_stats)
+
+    pools = connections = pool_requests = idle = 0
+    if http_session is not None:
+        for adapter in set(http_session.adapters.values()):
+            pool_manager = adapter.poolmanager
+            for key in pool_manager.pools.keys():
+                pool = pool_manager.pools.get(key)
+                if pool is None:
+                    continue
+                pools += 1
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+                # the pool queue is filled with None for connections not made yet
+                if pool.pool is not None:
+                    idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+    stats['pool'] = {'pools': pools, 'connections_opened': connections,
+                     'requests_sent': pool_requests, 'idle_connections': idle,
+                     'max_size': SPOTIFY_POOL_SIZE}
+    stats['backoff_remaining'] = max(0.0, search_backoff.until - time.monotonic())
+    return stats
+
+# shared pause for all searches when spotify says we send too many requests
+class RateLimitBackoff:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.until = 0.0
+
+    # sleep until the pause is over
+    def wait(self):
+        while True:
+            with self.lock:
+                delay = self.until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    # start a pause (or make the current one longer)
+    def trigger(self, seconds):
+        with self.lock:
+            self.until = max(self.until, time.monotonic() + seconds)
+
+search_backoff = RateLimitBackoff()
+
+# read the Retry-After header from a 429 error
+def get_retry_after(error):
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return max(1.0, float(headers.get('Retry-After', 1)))
+    except (TypeError, ValueError):
+        return 1.0
+
+# run one search, wait and try again if we are rate limited
+def search_track(sp, query):
+    for attempt in range(SEARCH_MAX_RETRIES + 1):
+        search_backoff.wait()
+        try:
+            return sp.search(q=query, type='track', limit=1, market='US')
+        except SpotifyException as e:
+            if e.http_status == 429 and attempt < SEARCH_MAX_RETRIES:
+                retry_after = get_retry_after(e)
+                search_backoff.trigger(retry_after)
+                spotify_budget.pause(retry_after)
+                continue
+            count_metric('errors_total', stage='search')
+            print(f"Search error: {e}")
+            return None
+        except Exception as e:
+            count_metric('errors_total', stage='search')
+            print(f"Search error: {e}")
+            return None
+    return None
+
 # search for song on spotify
 def get_spotify_track(song, artist, sp):
     # remove special chars
-    song_clean = re.sub(r'[^\w\s]', '', song).strip()
-    artist_clean = re.sub(r'[^\w\s]', '', artist).strip() if artist else ''
+    song_clean = clean_search_text(song)
+    artist_clean = clean_search_text(artist)
+    
+    # check if we already looked up this song
+    cache_key = track_cache_key(song_clean, artist_clean)
+    found, cached = track_cache.get(cache_key)
+    if found:
+        count_metric('songs_total', result='found' if cached else 'not_found', source='cache')
+        return cached
     
     strategies = []
     
     if artist_clean:
-        strategies.append(f'track:"{song_clean}" artist:"{artist_clean}"') # exact match
-        strategies.append(f'{song_clean} {artist_clean}') # loose match
+        strategies.append(('exact', f'track:"{song_clean}" artist:"{artist_clean}"')) # exact match
+        strategies.append(('loose', f'{song_clean} {artist_clean}')) # loose match
     
-    strategies.append(f'track:"{song_clean}"') # just song name
+    strategies.append(('title', f'track:"{song_clean}"')) # just song name
     
-    # try searching with different strategies
-    for strategy in strategies:
-        try:
-            results = sp.search(q=strategy, type='track', limit=1, market='US')
-            if results['tracks']['items']:
-                return format_track_info(results['tracks']['items'][0])
-        except Exception as e:
-            print(f"Search error: {e}")
+    # try searching with different strategies, stop at the first match
+    search_failed = False
+    for name, strategy in strategies:
+        results = search_track(sp, strategy)
+        if results is None:
+            search_failed = True
             continue
-            
+        if results['tracks']['items']:
+            track_info = format_track_info(results['tracks']['items'][0])
+            track_cache.set(cache_key, track_info)
+            count_metric('search_strategy_hits_total', strategy=name)
+            count_metric('songs_total', result='found', source='spotify')
+            return track_info
+    
+    # only remember "not found" if spotify really answered every search
+    if not search_failed:
+        track_cache.set(cache_key, None, TRACK_CACHE_MISS_TTL)
+    count_metric('songs_total', result='error' if search_failed else 'not_found', source='spotify')
     return None
 
+# look up many songs at the same time, results keep the order of song_pairs
+# on_result(index, song, artist, track_info) is called as soon as each song is done
+def resolve_tracks(song_pairs, sp, on_result=None):
+    # the search threads add their time to the request that started them
+    timings = getattr(metrics_local, 'timings', None)
+
+    def resolve(index):
+        song, artist = song_pairs[index]
+        metrics_local.timings = timings
+        with timed_stage('search'):
+            track_info = get_spotify_track(song, artist, sp)
+        if on_result:
+            on_result(index, song, artist, track_info)
+        return track_info
+
+    if SEARCH_WORKERS <= 1 or len(song_pairs) < 2:
+        return [resolve(index) for index in range(len(song_pairs))]
+
+    workers = min(SEARCH_WORKERS, len(song_pairs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(resolve, range(len(song_pairs))))
+
 # helper to format track info
 def format_track_info(track):
     return {
@@ -204,6 +1730,172 @@ def format_track_info(track):
         'preview_url': track.get('preview_url')
     }
 
+# check and read the uploaded files of a request, returns (sources, error)
+def get_uploaded_files():
+    try:
+        if 'images' not in request.files:
+            return None, "No files part"
+    except RequestEntityTooLarge:
+        return None, UPLOAD_TOO_BIG_ERROR
+
+    files = request.files.getlist('images')
+    if not files or all(f.filename == '' for f in files):
+        return None, "No selected files"
+
+    if len(files) > 10:
+        return None, "Max 10 images allowed."
+
+    return read_uploaded_files([f for f in files if f and f.filename])
+
+# check the image size from its header, without decoding it
+def check_image_size(file):
+    try:
+        with Image.open(file.stream) as image:
+            width, height = image.size
+    except Exception:
+        return f"{file.filename} is not an image."
+
+    if width * height > MAX_IMAGE_PIXELS:
+        return f"{file.filename} is too big ({width}x{height})."
+    return None
+
+# read uploaded images straight from the request, returns (sources, error)
+# a source is the in-memory buffer of the upload, or a temp file path for very big images
+def read_uploaded_files(files):
+    sources = []
+    total_bytes = 0
+    try:
+        for file in files:
+            stream = file.stream
+            stream.seek(0, os.SEEK_END)
+            size = stream.tell()
+            stream.seek(0)
+
+            total_bytes += size
+            if total_bytes > MAX_UPLOAD_BYTES:
+                remove_files(sources)
+                return None, UPLOAD_TOO_BIG_ERROR
+
+            error = check_image_size(file)
+            if error:
+                remove_files(sources)
+                return None, error
+            stream.seek(0)
+
+            if isinstance(stream, UploadSpool):
+                sources.append(stream.detach())
+            else:
+                sources.append(stream.read())
+    except Exception:
+        remove_files(sources)
+        raise
+
+    return sources, None
+
+# delete temp files of uploads (sources kept in memory have nothing to delete)
+def remove_files(sources):
+    for source in sources:
+        if isinstance(source, str) and os.path.exists(source):
+            os.remove(source)
+
+# one background extraction, its events are kept in sqlite for the browser
+# the worker that runs the job writes them, any worker can read them
+class ExtractionJob:
+    def __init__(self, job_id, status='queued', finished=False, next_seq=0):
+        self.id = job_id
+        self.status = status
+        self.finished = finished
+        self.next_seq = next_seq
+        self.found = 0
+        self.lock = threading.Lock()
+
+    def add_event(self, event):
+        # searches report from many threads, the lock keeps the numbers in order
+        with self.lock:
+            db = get_job_db()
+            db.execute('INSERT INTO job_events (job_id, seq, event, created) VALUES (?, ?, ?, ?)',
+                       (self.id, self.next_seq, json.dumps(event), time.time()))
+            db.commit()
+            self.next_seq += 1
+            self.read_event(event)
+
+    # keep status and finished up to date with the events we wrote or read
+    def read_event(self, event):
+        if event['type'] == 'status':
+            self.status = event['status']
+        elif event['type'] in ('done', 'error'):
+            self.status = event['type']
+            self.finished = True
+
+    def set_status(self, status):
+        self.add_event({'type': 'status', 'status': status})
+
+    # called by resolve_tracks for every song
+    def add_result(self, index, song, artist, track_info):
+        if track_info:
+            with self.lock:
+                self.found += 1
+            self.add_event({'type': 'track', 'index': index, 'track': track_info})
+        else:
+            self.add_event({'type': 'not_found', 'index': index, 'song': song, 'artist': artist})
+
+    def finish(self, status, message=None):
+        event = {'type': status, 'found': self.found}
+        if message:
+            event['message'] = message
+        self.add_event(event)
+
+    def load_events(self, since=0):
+        rows = get_job_db().execute('SELECT event FROM job_events WHERE job_id = ? AND seq >= ? ORDER BY seq',
+                                    (self.id, since)).fetchall()
+        events = [json.loads(row[0]) for row in rows]
+        for event in events:
+            self.read_event(event)
+        return events
+
+    # events after index "since", checks again for up to timeout seconds if there are none yet
+    def events_since(self, since, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.load_events(since)
+            if events or self.finished or time.monotonic() >= deadline:
+                return events
+            time.sleep(JOB_POLL_INTERVAL)
+
+    # uris of found songs in the order they were extracted
+    @property
+    def track_uris(self):
+        tracks = {event['index']: event['track']['uri'] for event in self.load_events()
+                  if event['type'] == 'track'}
+        return [tracks[index] for index in sorted(tracks)]
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+
+def get_job_db():
+    return get_sqlite_db(JOB_DB, 'CREATE TABLE IF NOT EXISTS job_events (job_id TEXT, seq INTEGER, '
+                                 'event TEXT, created REAL, PRIMARY KEY (job_id, seq))')
+
+# make a new job and forget old ones
+def create_extraction_job():
+    db = get_job_db()
+    db.execute('DELETE FROM job_events WHERE job_id IN '
+               '(SELECT job_id FROM job_events WHERE seq = 0 AND created < ?)', (time.time() - JOB_TTL,))
+    db.commit()
+    job = ExtractionJob(secrets.token_urlsafe(16))
+    job.set_status('queued')
+    return job
+
+def get_job(job_id):
+    if not job_id:
+        return None
+    job = ExtractionJob(job_id)
+    try:
+        job.next_seq = len(job.load_events())
+    except sqlite3.Error as e:
+        print(f"Job error: {e}")
+        return None
+    return job if job.next_seq else None
+
 # home page route
 @app.route('/', methods=['GET', 'POST'])
 def upload_image():
@@ -211,42 +1903,23 @@ def upload_image():
         return render_template('upload.html')
 
     if request.method == 'POST':
-        if 'images' not in request.files:
-            return render_template('upload.html', error="No files part")
-        
-        files = request.files.getlist('images')
-        if not files or all(f.filename == '' for f in files):
-            return render_template('upload.html', error="No selected files")
-        
-        if len(files) > 10:
-            return render_template('upload.html', error="Max 10 images allowed.")
-
-        all_song_pairs = set() 
-        filepaths = []
+        with timed_stage('upload'):
+            sources, error = get_uploaded_files()
+        if error:
+            return render_template('upload.html', error=error)
         
         try:
-            # loop through uploaded files
-            for file in files:
-                if file and file.filename:
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-                    file.save(filepath)
-                    filepaths.append(filepath)
-                    
-                    # extract text and songs
-                    text = extract_text_optimized(filepath)
-                    pairs = extract_songs_from_text(text)
-                    for p in pairs:
-                        all_song_pairs.add(p)
+            # extract text and songs from all images at once
+            all_song_pairs = extract_songs_parallel(sources)
             
             # search on spotify
-            token_info = session.get('token_info')
-            sp = spotipy.Spotify(auth=token_info['access_token'])
+            sp = get_spotify_client()
             
             found_songs = []
             not_found = []
             
-            for song, artist in all_song_pairs:
-                track_info = get_spotify_track(song, artist, sp)
+            track_infos = resolve_tracks(all_song_pairs, sp)
+            for (song, artist), track_info in zip(all_song_pairs, track_infos):
                 if track_info:
                     found_songs.append(track_info)
                 else:
@@ -254,11 +1927,10 @@ def upload_image():
             
             # save uris in session
             session['track_uris'] = [s['uri'] for s in found_songs]
+            session.pop('job_id', None)
             
-            # delete files after processing
-            for filepath in filepaths:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+            # delete temp files after processing
+            remove_files(sources)
 
             return render_template('songs.html',
                                    songs=found_songs,
@@ -267,38 +1939,133 @@ def upload_image():
                                    
         except Exception as e:
             # clean up if error
-            for filepath in filepaths:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+            remove_files(sources)
+            count_metric('errors_total', stage='request')
             print(f"Error: {e}")
             return render_template('upload.html', error="An error occurred during processing.")
 
     return render_template('upload.html')
 
+# runs in the background: ocr, then spotify searches, and tells the job about every result
+def run_extraction_job(job, sources, token_info):
+    metrics_local.timings = StageTimings() if LOG_TIMINGS else None
+    start = time.perf_counter()
+    try:
+        job.set_status('ocr')
+        all_song_pairs = extract_songs_parallel(sources)
+        remove_files(sources)
+        job.add_event({'type': 'extracted', 'total': len(all_song_pairs)})
+
+        job.set_status('searching')
+        sp, _ = create_spotify_client(token_info)
+        resolve_tracks(all_song_pairs, sp, on_result=job.add_result)
+
+        job.finish('done')
+    except Exception as e:
+        remove_files(sources)
+        count_metric('errors_total', stage='job')
+        print(f"Job error: {e}")
+        job.finish('error', "An error occurred during processing.")
+    finally:
+        count_metric('jobs_total', status=job.status)
+        if metrics_local.timings is not None:
+            log_timings({'job': job.id, 'status': job.status}, time.perf_counter() - start,
+                        metrics_local.timings)
+            metrics_local.timings = None
+
+# start an extraction job, returns the job id right away
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    if 'token_info' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+
+    sources = []
+    try:
+        with timed_stage('upload'):
+            sources, error = get_uploaded_files()
+        if error:
+            return jsonify({'success': False, 'message': error}), 400
+
+        job = create_extraction_job()
+        job_executor.submit(run_extraction_job, job, sources, session['token_info'])
+    except Exception as e:
+        remove_files(sources or [])
+        print(f"Error: {e}")
+        return jsonify({'success': False, 'message': 'Could not start processing'}), 500
+
+    session['job_id'] = job.id
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'page_url': url_for('job_page', job_id=job.id),
+        'status_url': url_for('job_status', job_id=job.id),
+        'events_url': url_for('job_events', job_id=job.id),
+    }), 202
+
+# songs page that fills in while the job runs
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    if 'token_info' not in session:
+        return redirect('/')
+    if get_job(job_id) is None:
+        return render_template('upload.html', error="This extraction has expired.")
+
+    return render_template('songs.html', songs=[], not_found=[], total_extracted=0, job_id=job_id,
+                           job_events=JOB_EVENTS)
+
+# polling: events after the "since" index
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+
+    since = request.args.get('since', 0, type=int)
+    events = job.events_since(since)
+    return jsonify({'success': True, 'status': job.status, 'events': events,
+                    'next': since + len(events)})
+
+# server-sent events: every event of the job as soon as it happens
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+
+    # a reconnecting browser tells us the last event it got
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    since = last_id + 1 if last_id is not None else 0
+
+    def stream(since):
+        while True:
+            events = job.events_since(since, timeout=JOB_KEEPALIVE)
+            if not events:
+                if job.finished:
+                    return
+                # comment line so proxies keep the connection open
+                yield ': keepalive\n\n'
+                continue
+            for event in events:
+                yield f"id: {since}\ndata: {json.dumps(event)}\n\n"
+                since += 1
+
+    return Response(stream(since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # login route
 @app.route('/login')
 def login():
     if not SPOTIPY_CLIENT_ID or not SPOTIPY_CLIENT_SECRET or not SPOTIPY_REDIRECT_URI:
         return "Error: Spotify credentials not configured in .env", 500
         
-    sp_oauth = SpotifyOAuth(
-        SPOTIPY_CLIENT_ID,
-        SPOTIPY_CLIENT_SECRET,
-        SPOTIPY_REDIRECT_URI,
-        scope=SCOPE
-    )
+    sp_oauth = create_spotify_oauth()
     auth_url = sp_oauth.get_authorize_url()
     return redirect(auth_url)
 
 # callback route after login
 @app.route('/callback')
 def callback():
-    sp_oauth = SpotifyOAuth(
-        SPOTIPY_CLIENT_ID,
-        SPOTIPY_CLIENT_SECRET,
-        SPOTIPY_REDIRECT_URI,
-        scope=SCOPE
-    )
+    sp_oauth = create_spotify_oauth()
     session.clear()
     code = request.args.get('code')
     try:
@@ -319,13 +2086,15 @@ def add_song():
         return jsonify({'success': False, 'message': 'No track URI'}), 400
 
     try:
-        token_info = session.get('token_info')
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = get_spotify_client()
         
         playlist_id = get_or_create_playlist(sp)
-        sp.playlist_add_items(playlist_id, [track_uri])
+        # waits for the batch this song was put in
+        result = get_playlist_queue(playlist_id).add([track_uri], sp)[track_uri]
         
-        return jsonify({'success': True})
+        if result['status'] == 'failed':
+            return jsonify({'success': False, 'status': 'failed', 'message': result['message']}), 500
+        return jsonify({'success': True, 'status': result['status']})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
@@ -335,22 +2104,28 @@ def add_all():
     if 'token_info' not in session:
         return jsonify({'success': False, 'message': 'Not logged in'}), 401
     
-    track_uris = session.get('track_uris')
+    # songs of the last background job, or of the last normal upload
+    job = get_job(session.get('job_id'))
+    track_uris = job.track_uris if job else session.get('track_uris')
     if not track_uris:
         return jsonify({'success': False, 'message': 'No songs to add'}), 400
     
     try:
-        token_info = session.get('token_info')
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = get_spotify_client()
         
         playlist_id = get_or_create_playlist(sp)
         
-        # add songs in batches of 100
-        for i in range(0, len(track_uris), 100):
-            batch = track_uris[i:i+100]
-            sp.playlist_add_items(playlist_id, batch)
+        # songs already in the playlist are skipped, the rest is added in batches of 100
+        results = get_playlist_queue(playlist_id).add(track_uris, sp)
+        statuses = {uri: result['status'] for uri, result in results.items()}
+        added = sum(1 for status in statuses.values() if status == 'added')
+        duplicates = sum(1 for status in statuses.values() if status == 'duplicate')
+        failed = [result['message'] for result in results.values() if result['status'] == 'failed']
         
-        return jsonify({'success': True, 'count': len(track_uris)})
+        if failed:
+            return jsonify({'success': False, 'message': failed[0], 'count': added,
+                            'duplicates': duplicates, 'results': statuses}), 500
+        return jsonify({'success': True, 'count': added, 'duplicates': duplicates, 'results': statuses})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
@@ -364,28 +2139,301 @@ def search_songs():
     if not query:
         return jsonify({'success': False, 'message': 'No query'}), 400
 
+    # same query was searched before
+    cache_key = query.lower()
+    found, songs = search_cache.get(cache_key)
+    if found:
+        return jsonify({'success': True, 'songs': songs})
+
     try:
-        token_info = session.get('token_info')
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = get_spotify_client()
         results = sp.search(q=query, type='track', limit=10, market='US')
         
         songs = [format_track_info(track) for track in results['tracks']['items']]
+        search_cache.set(cache_key, songs)
         return jsonify({'success': True, 'songs': songs})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+# connection pool and throttling numbers of this worker
+@app.route('/stats/spotify')
+def spotify_stats_route():
+    return jsonify(spotify_client_stats())
+
+# prometheus text format, numbers are for this worker process (and its ocr pool)
+@app.route('/metrics')
+def metrics_route():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# {name="value",...} with quotes, backslashes and newlines escaped
+def format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+# all metrics as prometheus text: counters, histograms, spotify client and cache numbers
+def render_metrics():
+    counters, histograms = metrics.snapshot()
+    families = {}
+
+    def add(name, kind, help_text, labels, value):
+        family = families.setdefault(name, (kind, help_text, []))
+        family[2].append(f"{METRICS_PREFIX}{name}{format_labels(labels)} {value}")
+
+    for (name, labels), value in sorted(counters.items()):
+        kind, help_text = METRICS_HELP.get(name, ('counter', name))
+        add(name, kind, help_text, labels, value)
+
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        kind, help_text = METRICS_HELP.get(name, ('histogram', name))
+        family = families.setdefault(name, (kind, help_text, []))
+        cumulative = 0
+        for bound, bucket_count in zip(METRICS_BUCKETS, buckets):
+            cumulative += bucket_count
+            family[2].append(f"{METRICS_PREFIX}{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+        family[2].append(f"{METRICS_PREFIX}{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+        family[2].append(f"{METRICS_PREFIX}{name}_sum{format_labels(labels)} {total}")
+        family[2].append(f"{METRICS_PREFIX}{name}_count{format_labels(labels)} {count}")
+
+    stats = spotify_client_stats()
+    add('spotify_requests_total', 'counter', 'Spotify API calls', (), stats['requests'])
+    add('spotify_throttled_total', 'counter', 'Spotify answers with 429', (), stats['throttled'])
+    add('spotify_budget_waits_total', 'counter', 'Calls that waited for the request budget', (), stats['budget_waits'])
+    add('spotify_budget_wait_seconds_total', 'counter', 'Time spent waiting for the request budget', (),
+        stats['budget_wait_seconds'])
+    add('spotify_token_refreshes_total', 'counter', 'Access tokens refreshed', (), stats['token_refreshes'])
+    add('spotify_pool_connections_opened_total', 'counter', 'Connections opened by the Spotify pool', (),
+        stats['pool']['connections_opened'])
+    add('spotify_pool_idle_connections', 'gauge', 'Open connections waiting in the Spotify pool', (),
+        stats['pool']['idle_connections'])
+    add('spotify_backoff_remaining_seconds', 'gauge', 'Time left in the 429 pause of all searches', (),
+        stats['backoff_remaining'])
+
+    for cache in (track_cache, search_cache, ocr_cache):
+        cache_stats = cache.stats()
+        labels = (('cache', cache.name),)
+        add('cache_hits_total', 'counter', 'Cache hits', labels, cache_stats['hits'])
+        add('cache_misses_total', 'counter', 'Cache misses', labels, cache_stats['misses'])
+        add('cache_entries', 'gauge', 'Entries in the memory cache', labels, cache_stats['size'])
+
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {METRICS_PREFIX}{name} {help_text}")
+        lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
 # helper to get playlist id
 def get_or_create_playlist(sp):
     playlist_id = session.get('playlist_id')
     if not playlist_id:
-        user_id = sp.current_user()['id']
-        import random, string
-        suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-        playlist_name = f'Extracted Playlist {suffix}'
-        playlist = sp.user_playlist_create(user=user_id, name=playlist_name, public=False)
-        playlist_id = playlist['id']
+        # the user id doesn't change, so only ask spotify once per session
+        user_id = session.get('spotify_user_id')
+        if not user_id:
+            user_id = sp.current_user()['id']
+            session['spotify_user_id'] = user_id
+        playlist_id = get_user_playlist(sp, user_id)
         session['playlist_id'] = playlist_id
     return playlist_id
 
+def get_playlist_db():
+    # no automatic transactions, get_user_playlist starts its own
+    return get_sqlite_db(PLAYLIST_DB, 'CREATE TABLE IF NOT EXISTS playlists '
+                                      '(user_id TEXT PRIMARY KEY, playlist_id TEXT, created REAL)',
+                         isolation_level=None)
+
+# the playlist a user's clicks go to, made by the first request of all workers
+# a row without playlist id means another request is making it, the others wait for it
+def get_user_playlist(sp, user_id):
+    try:
+        db = get_playlist_db()
+        while True:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT playlist_id, created FROM playlists WHERE user_id = ?',
+                                 (user_id,)).fetchone()
+                now = time.time()
+                # a playlist of a while ago, or a request that gave up: make a new one
+                claim = row is None or now - row[1] > (PLAYLIST_STATE_TTL if row[0] else PLAYLIST_CREATE_TIMEOUT)
+                if claim:
+                    db.execute('INSERT OR REPLACE INTO playlists (user_id, playlist_id, created) '
+                               'VALUES (?, NULL, ?)', (user_id, now))
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                db.execute('ROLLBACK')
+                raise
+            if claim:
+                break
+            if row[0]:
+                return row[0]
+            time.sleep(PLAYLIST_POLL_INTERVAL)
+    except sqlite3.Error as e:
+        # don't block adding songs just because the file is broken
+        print(f"Playlist error: {e}")
+        return create_playlist(sp, user_id)
+
+    try:
+        playlist_id = create_playlist(sp, user_id)
+    except Exception:
+        # let the next request try again
+        try:
+            db.execute('DELETE FROM playlists WHERE user_id = ? AND playlist_id IS NULL', (user_id,))
+        except sqlite3.Error as e:
+            print(f"Playlist error: {e}")
+        raise
+    try:
+        db.execute('UPDATE playlists SET playlist_id = ?, created = ? WHERE user_id = ?',
+                   (playlist_id, time.time(), user_id))
+    except sqlite3.Error as e:
+        print(f"Playlist error: {e}")
+    return playlist_id
+
+# make a new private playlist for the user
+def create_playlist(sp, user_id):
+    import random, string
+    suffix = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
+    playlist_name = f'Extracted Playlist {suffix}'
+    playlist = sp.user_playlist_create(user=user_id, name=playlist_name, public=False)
+    playlist_id = playlist['id']
+    # a new playlist is empty, no need to fetch its songs
+    get_playlist_queue(playlist_id).set_existing(set())
+    return playlist_id
+
+# collects songs to add to one playlist and sends them to spotify together
+# nothing waits when the queue is idle: the first request sends its songs right away,
+# songs that come in while a call is running go together in the next call
+class PlaylistQueue:
+    def __init__(self, playlist_id):
+        self.playlist_id = playlist_id
+        self.lock = threading.Lock()
+        # tells the waiting requests that a call is done
+        self.changed = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.sending = False
+        self.sp = None
+        self.existing = None
+        self.existing_time = 0
+        self.last_used = time.time()
+
+    def set_existing(self, uris):
+        with self.flush_lock:
+            self.existing = set(uris)
+            self.existing_time = time.time()
+
+    # queue songs and wait until they are sent, returns {uri: {'status': ...}}
+    # status is "added", "duplicate" (already in the playlist) or "failed"
+    def add(self, uris, sp):
+        futures = []
+        deadline = time.time() + PLAYLIST_ADD_TIMEOUT
+        with self.lock:
+            self.sp = sp
+            self.last_used = time.time()
+            for uri in uris:
+                future = Future()
+                self.pending.append((uri, future))
+                futures.append((uri, future))
+
+        while True:
+            with self.lock:
+                remaining = deadline - time.time()
+                if remaining <= 0 or all(future.done() for _, future in futures):
+                    break
+                if self.sending or not self.pending:
+                    # another request is sending, our songs are in that call or the next one
+                    self.changed.wait(remaining)
+                    continue
+                # nobody is sending: send everything that is waiting, also for the others
+                batch = self.pending
+                self.pending = []
+                self.sending = True
+                sp = self.sp
+            try:
+                self.flush(batch, sp)
+            finally:
+                with self.lock:
+                    self.sending = False
+                    self.changed.notify_all()
+
+        results = {}
+        for uri, future in futures:
+            if future.done():
+                result = future.result()
+            else:
+                result = {'status': 'failed', 'message': 'Timed out'}
+            # the same song can be in the list twice, keep the better answer
+            if uri not in results or result['status'] == 'added':
+                results[uri] = result
+        return results
+
+    # send a batch of queued songs
+    def flush(self, batch, sp):
+        with self.flush_lock:
+            try:
+                # read what is already in the playlist once (again after PLAYLIST_STATE_TTL)
+                if self.existing is None or time.time() - self.existing_time > PLAYLIST_STATE_TTL:
+                    self.existing = fetch_playlist_uris(sp, self.playlist_id)
+                    self.existing_time = time.time()
+            except Exception as e:
+                for uri, future in batch:
+                    future.set_result({'status': 'failed', 'message': str(e)})
+                return
+
+            to_add = []
+            for uri, future in batch:
+                if uri in self.existing or uri in to_add:
+                    future.set_result({'status': 'duplicate'})
+                else:
+                    to_add.append(uri)
+
+            added = {}
+            for i in range(0, len(to_add), PLAYLIST_BATCH_SIZE):
+                chunk = to_add[i:i + PLAYLIST_BATCH_SIZE]
+                try:
+                    sp.playlist_add_items(self.playlist_id, chunk)
+                    self.existing.update(chunk)
+                    result = {'status': 'added'}
+                except Exception as e:
+                    result = {'status': 'failed', 'message': str(e)}
+                for uri in chunk:
+                    added[uri] = result
+
+            for uri, future in batch:
+                if not future.done():
+                    future.set_result(added[uri])
+
+playlist_queues = {}
+playlist_queues_lock = threading.Lock()
+
+# the queue of a playlist, queues that were not used for a while are dropped
+def get_playlist_queue(playlist_id):
+    now = time.time()
+    with playlist_queues_lock:
+        for old_id in [q.playlist_id for q in playlist_queues.values()
+                       if now - q.last_used > PLAYLIST_STATE_TTL and not q.pending and not q.sending]:
+            del playlist_queues[old_id]
+        playlist_queue = playlist_queues.get(playlist_id)
+        if playlist_queue is None:
+            playlist_queue = PlaylistQueue(playlist_id)
+            playlist_queues[playlist_id] = playlist_queue
+        playlist_queue.last_used = now
+        return playlist_queue
+
+# uris of all songs in a playlist
+def fetch_playlist_uris(sp, playlist_id):
+    uris = set()
+    results = sp.playlist_items(playlist_id, fields='items(track(uri)),next', limit=100,
+                                additional_types=('track',))
+    while results:
+        for item in results['items']:
+            if item.get('track') and item['track'].get('uri'):
+                uris.add(item['track']['uri'])
+        results = sp.next(results) if results.get('next') else None
+    return uris
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
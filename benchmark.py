@@ -0,0 +1,569 @@
+# benchmarks for the extraction pipeline
+#
+# compare the preprocessing backends (speed, peak memory and output):
+#   python benchmark.py preprocess sample-image.png --scale 1,3 --repeat 5
+#
+# compare the ocr backends (tesseract program vs resident tesserocr engine):
+#   python benchmark.py ocr sample-image.png --repeat 5
+#
+# run screenshots through the whole pipeline against a local spotify stand-in
+# (no credentials needed), with latency percentiles, throughput and accuracy:
+#   python benchmark.py pipeline --synthetic 5 --latency 80 --rate-429 0.02
+import argparse
+import difflib
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak rss is left out there
+    resource = None
+
+from PIL import Image, ImageDraw, ImageFont
+
+import app
+
+# highest memory use of this process so far, in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+# load the images and make bigger copies to test high resolution screenshots
+# returns (name, png bytes, megapixels) for every image and scale
+def load_images(paths, scales):
+    images = []
+    for path in paths:
+        original = Image.open(path)
+        original.load()
+        for scale in scales:
+            image = original
+            if scale != 1:
+                size = (int(original.width * scale), int(original.height * scale))
+                image = original.resize(size, Image.Resampling.LANCZOS)
+            data = io.BytesIO()
+            image.save(data, 'PNG')
+            images.append((f"{path} x{scale}", data.getvalue(), image.width * image.height / 1e6))
+    return images
+
+# runs in its own process, so the peak memory only belongs to this backend
+# the images are made (and scaled up) by the parent, this process only gets the png bytes
+def run_preprocess_backend(backend, images, repeat, results):
+    megapixels = sum(mp for _, _, mp in images)
+
+    # first run is a warm up (imports, numpy buffers), it counts for peak memory
+    rss_before = peak_rss_mb()
+    for _, data, _ in images:
+        app.preprocess_image(data, backend=backend)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, data, _ in images:
+            app.preprocess_image(data, backend=backend)
+    elapsed = time.perf_counter() - start
+    rss_after = peak_rss_mb()
+
+    results.put({
+        'backend': app.get_preprocess_backend(backend),
+        'ms_per_image': elapsed * 1000 / (repeat * len(images)),
+        'ms_per_megapixel': elapsed * 1000 / (repeat * megapixels),
+        'peak_rss_growth_mb': rss_after - rss_before if rss_before is not None else None,
+    })
+
+# run both backends on the same image and report how different they are
+def compare_preprocess_backends(image_source):
+    np = app.np
+    pil_image = app.preprocess_image(image_source, backend='pil')
+    numpy_image = app.preprocess_image(image_source, backend='numpy')
+    difference = np.abs(np.asarray(pil_image, dtype=np.int16) - np.asarray(numpy_image, dtype=np.int16))
+    return {'max_difference': int(difference.max()),
+            'changed_pixels': float((difference > 1).mean())}
+
+def benchmark_preprocess(args):
+    scales = [float(scale) for scale in args.scale.split(',')]
+    images = load_images(args.images, scales)
+    # a spawned child starts with the peak memory of this process (linux keeps it over exec),
+    # a child of the fork server starts small, so its peak is only the preprocessing
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    else:
+        context = multiprocessing.get_context('spawn')
+
+    print(f"{'backend':<8} {'ms/image':>10} {'ms/MP':>10} {'peak rss +MB':>14}")
+    for backend in ('pil', 'numpy'):
+        results = context.Queue()
+        process = context.Process(target=run_preprocess_backend,
+                                  args=(backend, images, args.repeat, results))
+        process.start()
+        row = results.get()
+        process.join()
+
+        rss = f"{row['peak_rss_growth_mb']:.1f}" if row['peak_rss_growth_mb'] is not None else 'n/a'
+        print(f"{row['backend']:<8} {row['ms_per_image']:>10.1f} {row['ms_per_megapixel']:>10.1f} {rss:>14}")
+
+    # the numpy backend has to give the same image as the pil one
+    if app.np is None:
+        print("numpy is not installed, skipping the output check")
+        return
+    print()
+    for name, data, _ in images:
+        result = compare_preprocess_backends(data)
+        print(f"{name}: max difference {result['max_difference']}, "
+              f"{result['changed_pixels'] * 100:.2f}% pixels differ by more than 1")
+
+# time extract_text_optimized with every ocr backend that is installed
+def benchmark_ocr(args):
+    images = [(name, data) for name, data, _ in load_images(args.images, [1])]
+    backends = ['pytesseract'] + (['tesserocr'] if app.tesserocr is not None else [])
+
+    print(f"{'backend':<12} {'first ms':>10} {'ms/image':>10} {'chars':>8}")
+    for backend in backends:
+        app.OCR_BACKEND = backend
+
+        # the first call also loads the engine for tesserocr
+        start = time.perf_counter()
+        text = app.extract_text_optimized(images[0][1])
+        first = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for _, data in images:
+                text = app.extract_text_optimized(data)
+        per_image = (time.perf_counter() - start) * 1000 / (args.repeat * len(images))
+
+        print(f"{app.get_ocr_backend():<12} {first:>10.1f} {per_image:>10.1f} {len(text):>8}")
+
+    if app.tesserocr is None:
+        print("tesserocr is not installed, only the tesseract program was timed")
+
+# songs in sample-image.png (full names, the screenshot cuts some of them off)
+SAMPLE_TRACKS = [
+    ('Turn Back Time', 'Daniel Schulz'),
+    ('Is It Just Me? (feat. Charlie Puth)', 'Sasha Alex Sloan, Charlie Puth'),
+    ('Sign of the Times', 'Harry Styles'),
+    ('Leave Before You Love Me (with Jonas Brothers)', 'Marshmello, Jonas Brothers'),
+    ('human', 'Christina Perri'),
+    ('Coping', 'Rosie Darling'),
+    ('tomorrow tonight', 'Loote'),
+    ('After Dark', 'Mr.Kitty'),
+]
+
+# words for the made up songs of the synthetic playlists
+TITLE_WORDS = ['Midnight', 'River', 'Golden', 'Hours', 'Paper', 'Hearts', 'Electric', 'Summer',
+               'Lost', 'Highway', 'Silver', 'Lights', 'Ocean', 'Eyes', 'Neon', 'Dreams', 'Broken',
+               'Wings', 'Falling', 'Stars', 'Wild', 'Fire', 'Quiet', 'Storm', 'Velvet', 'Sky']
+ARTIST_WORDS = ['Luna', 'Parker', 'The Wolves', 'Mira', 'Jonah', 'Atlas', 'Sage', 'Kids',
+                'Ivy', 'Monroe', 'Echo', 'Bay', 'Nova', 'Reed', 'Hollow', 'Coast']
+
+# made up (title, artist) pairs, the same for the same seed
+def synthetic_tracks(count, seed):
+    rng = random.Random(seed)
+    tracks = []
+    for _ in range(count):
+        title = ' '.join(rng.sample(TITLE_WORDS, rng.randint(1, 4)))
+        if rng.random() < 0.2:
+            title += f" (feat. {rng.choice(ARTIST_WORDS)})"
+        artist = ' '.join(rng.sample(ARTIST_WORDS, rng.randint(1, 2)))
+        if rng.random() < 0.3:
+            artist += ', ' + rng.choice(ARTIST_WORDS)
+        tracks.append((title, artist))
+    return tracks
+
+# a font that works on most systems, the PIL bitmap font as a last resort
+def load_font(size, bold=False):
+    for name in (('DejaVuSans-Bold.ttf', 'Arial Bold.ttf', 'arialbd.ttf') if bold
+                 else ('DejaVuSans.ttf', 'Arial.ttf', 'arial.ttf')):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 has only one size
+        return ImageFont.load_default()
+
+# cut text with "..." like spotify does when it doesn't fit
+def fit_text(draw, text, font, width):
+    if draw.textlength(text, font=font) <= width:
+        return text
+    while text and draw.textlength(text + '...', font=font) > width:
+        text = text[:-1]
+    return text.rstrip() + '...'
+
+# draw a dark mode track list that looks like a spotify screenshot
+def render_playlist(tracks, seed, scale=1.0):
+    rng = random.Random(seed)
+    row_height = int(84 * scale)
+    width = int(760 * scale)
+    image = Image.new('RGB', (width, row_height * len(tracks) + int(10 * scale)), (18, 18, 18))
+    draw = ImageDraw.Draw(image)
+    title_font = load_font(int(22 * scale))
+    small_font = load_font(int(19 * scale))
+
+    for i, (title, artist) in enumerate(tracks):
+        top = int(10 * scale) + i * row_height
+        # album art
+        color = tuple(rng.randint(30, 220) for _ in range(3))
+        draw.rectangle([int(15 * scale), top, int(75 * scale), top + int(60 * scale)], fill=color)
+
+        left = int(93 * scale)
+        draw.text((left, top + int(3 * scale)), fit_text(draw, title, title_font, 265 * scale),
+                  font=title_font, fill=(255, 255, 255))
+        # some rows have the small "video" icon in front of the artist
+        artist_left = left
+        if rng.random() < 0.5:
+            draw.rectangle([left, top + int(37 * scale), left + int(20 * scale), top + int(57 * scale)],
+                           outline=(167, 167, 167), width=max(1, int(2 * scale)))
+            artist_left += int(31 * scale)
+        draw.text((artist_left, top + int(36 * scale)),
+                  fit_text(draw, artist, small_font, 265 * scale - (artist_left - left)),
+                  font=small_font, fill=(167, 167, 167))
+
+        # album and duration columns
+        draw.text((int(392 * scale), top + int(20 * scale)), fit_text(draw, title, small_font, 180 * scale),
+                  font=small_font, fill=(167, 167, 167))
+        draw.text((int(690 * scale), top + int(20 * scale)), f"{rng.randint(2, 5)}:{rng.randint(0, 59):02d}",
+                  font=small_font, fill=(167, 167, 167))
+
+    data = io.BytesIO()
+    image.save(data, 'PNG')
+    return data.getvalue()
+
+# list of (name, image bytes, [(title, artist), ...]) to run through the pipeline
+def build_corpus(paths, synthetic, songs_per_image, seed):
+    corpus = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        tracks = SAMPLE_TRACKS if os.path.basename(path) == 'sample-image.png' else []
+        corpus.append((path, data, tracks))
+    for i in range(synthetic):
+        tracks = synthetic_tracks(songs_per_image, seed + i)
+        corpus.append((f"synthetic-{i + 1}", render_playlist(tracks, seed + i), tracks))
+    return corpus
+
+# lower case words only, so "Mr.Kitty" and "mr kitty" are the same
+def normalize(text):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.replace('...', ' ').replace('…', ' ')).lower().split())
+
+# same text, or one is the start of the other (cut off), or only a few ocr mistakes
+def texts_match(found, expected):
+    found, expected = normalize(found), normalize(expected)
+    if not found or not expected:
+        return found == expected
+    if len(found) >= 4 and (expected.startswith(found) or found.startswith(expected)):
+        return True
+    return difflib.SequenceMatcher(None, found, expected).ratio() >= 0.85
+
+# spotify track object like the search api returns it
+def make_track(index, title, artist):
+    track_id = f"bench{index:018d}"
+    return {
+        'id': track_id,
+        'uri': f"spotify:track:{track_id}",
+        'name': title,
+        'artists': [{'name': name.strip()} for name in artist.split(',')],
+        'album': {'name': title, 'images': [{'url': f"https://i.scdn.co/image/{track_id}"}]},
+        'preview_url': None,
+    }
+
+# answers a search query like spotify would, from the tracks in the catalog
+def search_catalog(catalog, query):
+    fields = dict(re.findall(r'(\w+):"([^"]*)"', query))
+    free = normalize(re.sub(r'\w+:"[^"]*"', ' ', query)).split()
+    for track in catalog:
+        title = normalize(track['name'])
+        artists = normalize(' '.join(a['name'] for a in track['artists']))
+        if 'track' in fields:
+            wanted = normalize(fields['track'])
+            if not wanted or not (title.startswith(wanted) or wanted.startswith(title)):
+                continue
+        if 'artist' in fields and normalize(fields['artist']) not in artists:
+            continue
+        # every free word has to be in the title or artist (the last one can be cut off)
+        words = (title + ' ' + artists).split()
+        if all(word in words or any(w.startswith(word) for w in words) for word in free):
+            return [track]
+    return []
+
+# local stand-in for the spotify search api
+class StubSpotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalog, recorded, latency, jitter, rate_429, retry_after, seed):
+        super().__init__(('127.0.0.1', 0), StubSpotifyHandler)
+        self.catalog = catalog
+        self.recorded = recorded
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+
+    @property
+    def prefix(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/"
+
+class StubSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        with server.lock:
+            server.requests += 1
+            delay = max(0.0, server.latency + server.rng.uniform(-server.jitter, server.jitter))
+            throttle = server.rng.random() < server.rate_429
+            if throttle:
+                server.throttled += 1
+        time.sleep(delay / 1000)
+
+        if url.path != '/v1/search':
+            return self.send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+        if throttle:
+            return self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                  {'Retry-After': str(server.retry_after)})
+
+        query = parse_qs(url.query).get('q', [''])[0]
+        if query in server.recorded:
+            return self.send_json(200, server.recorded[query])
+        items = search_catalog(server.catalog, query)
+        self.send_json(200, {'tracks': {'items': items, 'total': len(items), 'limit': 1, 'offset': 0}})
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # keep the benchmark output readable
+    def log_message(self, format, *args):
+        pass
+
+# spotify client that saves every search answer, to replay them later with --responses
+class RecordingSpotify(app.PooledSpotify):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorded = {}
+        self.recorded_lock = threading.Lock()
+
+    def search(self, q, *args, **kwargs):
+        results = super().search(q, *args, **kwargs)
+        with self.recorded_lock:
+            self.recorded[q] = results
+        return results
+
+# value below which the given percent of the sorted values are (nearest rank)
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(values)))
+    return values[rank - 1]
+
+# run a function and add its time in ms to timings[stage]
+def timed(timings, stage, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+    return result
+
+# pair the found songs with the expected ones, returns [(index in found_pairs, expected pair), ...]
+def score_extraction(found_pairs, expected_pairs):
+    matched = []
+    unmatched = list(expected_pairs)
+    for index, (song, artist) in enumerate(found_pairs):
+        for expected in unmatched:
+            if texts_match(song, expected[0]) and (not artist or texts_match(artist, expected[1])):
+                unmatched.remove(expected)
+                matched.append((index, expected))
+                break
+    return matched
+
+def benchmark_pipeline(args):
+    corpus = build_corpus(args.images, args.synthetic, args.songs, args.seed)
+    catalog = []
+    for _, _, tracks in corpus:
+        for title, artist in tracks:
+            catalog.append(make_track(len(catalog), title, artist))
+
+    recorded = {}
+    if args.responses and not args.record:
+        with open(args.responses) as f:
+            recorded = json.load(f)
+
+    # spotify stand-in and a client pointed at it; --record talks to the real api instead
+    server = None
+    if args.record:
+        from spotipy.oauth2 import SpotifyClientCredentials
+        sp = RecordingSpotify(auth_manager=SpotifyClientCredentials(), requests_session=app.get_http_session(),
+                              requests_timeout=app.SPOTIFY_TIMEOUT)
+    else:
+        server = StubSpotifyServer(catalog, recorded, args.latency, args.jitter, args.rate_429,
+                                   args.retry_after, args.seed)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        sp, _ = app.create_spotify_client({'access_token': 'benchmark'})
+        sp.prefix = server.prefix
+
+    # the budget file is only for this run, so real workers aren't slowed down
+    budget_dir = tempfile.mkdtemp(prefix='spotify-budget-')
+    app.spotify_budget = app.RequestBudget(os.path.join(budget_dir, 'budget.sqlite3'),
+                                           args.rate_limit, app.SPOTIFY_BURST)
+
+    timings = {}
+    found_songs = expected_songs = correct_songs = 0
+    found_tracks = correct_tracks = searched = 0
+    rss_before = peak_rss_mb()
+    ocr_seconds = search_seconds = 0.0
+
+    for _ in range(args.repeat):
+        # every pass starts with an empty track cache, like a fresh worker
+        app.track_cache = app.ResultCache('track_cache', app.TRACK_CACHE_SIZE, app.TRACK_CACHE_TTL)
+
+        for name, data, tracks in corpus:
+            start = time.perf_counter()
+            timed(timings, 'preprocess_image', app.preprocess_image, data)
+            text = timed(timings, 'extract_text_optimized', app.extract_text_optimized, data)
+            pairs = timed(timings, 'extract_songs_from_text', app.extract_songs_from_text, text)
+            ocr_seconds += time.perf_counter() - start
+
+            matched = score_extraction(pairs, tracks)
+            found_songs += len(pairs)
+            expected_songs += len(tracks)
+            correct_songs += len(matched)
+
+            # search the songs at the same time, like resolve_tracks does
+            start = time.perf_counter()
+            workers = max(1, min(app.SEARCH_WORKERS, len(pairs)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(
+                    lambda pair: timed(timings, 'get_spotify_track', app.get_spotify_track, pair[0], pair[1], sp),
+                    pairs))
+            search_seconds += time.perf_counter() - start
+
+            searched += len(pairs)
+            found_tracks += sum(1 for track_info in results if track_info)
+            for index, (title, artist) in matched:
+                track_info = results[index]
+                if track_info and texts_match(track_info['name'], title) and texts_match(track_info['artist'], artist):
+                    correct_tracks += 1
+
+            if args.verbose:
+                print(f"{name}: {len(matched)}/{len(tracks)} songs read, {len(pairs)} found")
+                for (song, artist), track_info in zip(pairs, results):
+                    print(f"  {song} / {artist} -> {track_info['name'] if track_info else 'not found'}")
+
+    rss_after = peak_rss_mb()
+    images = len(corpus) * args.repeat
+
+    print(f"{'stage':<24} {'calls':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    report = {'stages': {}}
+    for stage in ('preprocess_image', 'extract_text_optimized', 'extract_songs_from_text', 'get_spotify_track'):
+        values = timings.get(stage, [])
+        row = {'calls': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90),
+               'p99': percentile(values, 99), 'mean': sum(values) / len(values) if values else 0.0}
+        report['stages'][stage] = row
+        print(f"{stage:<24} {row['calls']:>6} {row['p50']:>9.1f} {row['p90']:>9.1f} "
+              f"{row['p99']:>9.1f} {row['mean']:>9.1f}")
+    print("(extract_text_optimized includes its own preprocessing)")
+
+    report['throughput'] = {
+        'images_per_second': images / ocr_seconds if ocr_seconds else 0.0,
+        'searches_per_second': searched / search_seconds if search_seconds else 0.0,
+    }
+    report['peak_rss_mb'] = rss_after
+    report['peak_rss_growth_mb'] = rss_after - rss_before if rss_before is not None else None
+    report['accuracy'] = {
+        'song_recall': correct_songs / expected_songs if expected_songs else None,
+        'song_precision': correct_songs / found_songs if found_songs else None,
+        'found_on_spotify': found_tracks / searched if searched else None,
+        'right_track': correct_tracks / expected_songs if expected_songs else None,
+    }
+    report['spotify'] = app.spotify_client_stats()
+    if server is not None:
+        report['stub'] = {'requests': server.requests, 'throttled': server.throttled}
+
+    def percent(value):
+        return f"{value * 100:.1f}%" if value is not None else 'n/a'
+
+    print()
+    print(f"throughput: {report['throughput']['images_per_second']:.2f} images/s (ocr), "
+          f"{report['throughput']['searches_per_second']:.1f} songs/s (search)")
+    if rss_after is not None:
+        print(f"peak rss: {rss_after:.1f} MB (+{report['peak_rss_growth_mb']:.1f} MB during the run)")
+    accuracy = report['accuracy']
+    print(f"songs read: {percent(accuracy['song_recall'])} of expected, "
+          f"{percent(accuracy['song_precision'])} of found songs are real")
+    print(f"spotify: {percent(accuracy['found_on_spotify'])} found, "
+          f"{percent(accuracy['right_track'])} of expected songs matched the right track")
+    if server is not None:
+        print(f"stub: {server.requests} requests, {server.throttled} answered with 429")
+        server.shutdown()
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            json.dump(sp.recorded, f, indent=1)
+        print(f"saved {len(sp.recorded)} search responses to {args.record}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the extraction pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = commands.add_parser('preprocess', help='compare the preprocessing backends')
+    preprocess.add_argument('images', nargs='*', default=['sample-image.png'])
+    preprocess.add_argument('--scale', default='1,3', help='comma separated upscale factors')
+    preprocess.add_argument('--repeat', type=int, default=5)
+
+    ocr = commands.add_parser('ocr', help='compare the ocr backends')
+    ocr.add_argument('images', nargs='*', default=['sample-image.png'])
+    ocr.add_argument('--repeat', type=int, default=5)
+
+    pipeline = commands.add_parser('pipeline', help='run screenshots through ocr, parsing and search')
+    pipeline.add_argument('images', nargs='*', default=['sample-image.png'])
+    pipeline.add_argument('--synthetic', type=int, default=5, help='number of generated playlist screenshots')
+    pipeline.add_argument('--songs', type=int, default=8, help='songs per generated screenshot')
+    pipeline.add_argument('--seed', type=int, default=1)
+    pipeline.add_argument('--repeat', type=int, default=1)
+    pipeline.add_argument('--latency', type=float, default=50, help='stub search latency in ms')
+    pipeline.add_argument('--jitter', type=float, default=20, help='random +/- ms added to the latency')
+    pipeline.add_argument('--rate-429', type=float, default=0.0, help='share of searches answered with 429')
+    pipeline.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    pipeline.add_argument('--rate-limit', type=float, default=0, help='request budget per second (0 = off)')
+    pipeline.add_argument('--responses', help='json file of recorded search responses to replay')
+    pipeline.add_argument('--record', help='search the real api (client credentials) and save the responses here')
+    pipeline.add_argument('--json', help='also write the results to this json file')
+    pipeline.add_argument('--verbose', action='store_true', help='print the songs of every image')
+
+    args = parser.parse_args()
+    if args.command == 'preprocess':
+        benchmark_preprocess(args)
+    elif args.command == 'ocr':
+        benchmark_ocr(args)
+    elif args.command == 'pipeline':
+        benchmark_pipeline(args)
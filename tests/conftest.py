@@ -0,0 +1,5 @@
+# the app is a single module in the repository root, import it from there
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,50 @@
+# finding songs from tesseract word boxes (OCR_LAYOUT mode)
+import app
+
+# a word box like ocr_image_to_words returns them, words of one line are next to each other
+def line(text, left, top, height, line_id, conf=90):
+    words = []
+    for part in text.split():
+        width = len(part) * height // 2
+        words.append({'text': part, 'conf': conf, 'left': left, 'top': top,
+                      'width': width, 'height': height, 'line': line_id})
+        left += width + height // 3
+    return words
+
+# one row of a spotify track list: title, artist below it, album and time columns
+def track_row(title, artist, top, line_id):
+    return (line(title, 93, top, 22, line_id)
+            + line(artist, 93, top + 33, 19, line_id + 1)
+            + line('Some Album Name', 392, top + 17, 19, line_id + 2)
+            + line('3:45', 690, top + 17, 19, line_id + 3))
+
+def test_titles_are_paired_with_the_artist_below():
+    words = (line('Liked Songs', 20, 10, 40, 0)
+             + track_row('Blinding Lights', 'The Weeknd', 100, 10)
+             + track_row('Sign of the Times', 'Harry Styles', 184, 20)
+             + track_row('Dark Red', 'Steve Lacy', 268, 30))
+    assert app.extract_songs_from_words(words) == [
+        ('Blinding Lights', 'The Weeknd'),
+        ('Sign of the Times', 'Harry Styles'),
+        ('Dark Red', 'Steve Lacy'),
+    ]
+
+def test_unsure_words_are_left_out():
+    words = (track_row('Blinding Lights', 'The Weeknd', 100, 10)
+             + line('Dark Red', 93, 184, 22, 20, conf=20)
+             + line('Steve Lacy', 93, 217, 19, 21, conf=20))
+    assert app.extract_songs_from_words(words) == [('Blinding Lights', 'The Weeknd')]
+
+def test_lone_lines_in_the_track_list_are_split_or_kept():
+    words = (track_row('Blinding Lights', 'The Weeknd', 100, 10)
+             + line('Dark Red - Steve Lacy', 93, 200, 22, 20)
+             # far below, too far for an artist line
+             + line('Heat Waves', 93, 320, 22, 21))
+    assert app.extract_songs_from_words(words) == [
+        ('Blinding Lights', 'The Weeknd'),
+        ('Dark Red', 'Steve Lacy'),
+        ('Heat Waves', ''),
+    ]
+
+def test_no_words_gives_no_songs():
+    assert app.extract_songs_from_words([]) == []
@@ -0,0 +1,87 @@
+# stitching screenshots taken while scrolling one playlist
+# the screenshots are cut from a long playlist drawn by the benchmark
+import io
+
+import pytest
+from PIL import Image
+
+import app
+import benchmark
+
+# layout of benchmark.render_playlist at scale 1
+ROW_HEIGHT = 84
+TOP_PADDING = 10
+ART_HEIGHT = 60
+
+VIEW_HEIGHT = 520
+# where the top of every screenshot is in the long playlist
+SCROLLS = [0, 250, 560, 790, 1000]
+
+@pytest.fixture(scope='module')
+def playlist():
+    tracks = benchmark.synthetic_tracks(18, 7)
+    image = Image.open(io.BytesIO(benchmark.render_playlist(tracks, 7))).convert('RGB')
+    return tracks, image
+
+def screenshot(image, top, height=VIEW_HEIGHT):
+    data = io.BytesIO()
+    image.crop((0, top, image.width, top + height)).save(data, 'PNG')
+    return data.getvalue()
+
+# the songs that are fully inside rows crop_top.. of the screenshot at scroll
+def visible_tracks(tracks, scroll, crop_top):
+    visible = []
+    for i, track in enumerate(tracks):
+        top = TOP_PADDING + i * ROW_HEIGHT
+        if scroll + crop_top <= top and top + ART_HEIGHT <= scroll + VIEW_HEIGHT:
+            visible.append(track)
+    return visible
+
+def test_crop_tops_start_at_the_new_rows(playlist):
+    tracks, image = playlist
+    signatures = [app.image_row_signatures(screenshot(image, scroll)) for scroll in SCROLLS]
+    tops = app.find_new_content_tops(signatures)
+
+    assert tops[0] == 0
+    for previous, scroll, top, (_, _, rows) in zip(SCROLLS, SCROLLS[1:], tops[1:], signatures[1:]):
+        # first row that was not in the previous screenshot
+        new_rows = previous + VIEW_HEIGHT - scroll
+        assert new_rows - int(VIEW_HEIGHT * app.STITCH_MARGIN) - ROW_HEIGHT <= top <= new_rows
+        # the cut is on a plain row, not through a line of text
+        assert rows[top] is None
+
+def test_screenshot_inside_the_previous_one_is_skipped(playlist):
+    tracks, image = playlist
+    signatures = [app.image_row_signatures(screenshot(image, 0, 1000)),
+                  app.image_row_signatures(screenshot(image, 300))]
+    assert app.find_new_content_tops(signatures) == [0, None]
+
+def test_screenshots_are_not_stitched_without_overlap(playlist):
+    tracks, image = playlist
+    signatures = [app.image_row_signatures(screenshot(image, 0)),
+                  app.image_row_signatures(screenshot(image, 1000))]
+    assert app.find_new_content_tops(signatures) == [0, 0]
+
+def test_merged_songs_are_in_scroll_order(playlist, monkeypatch):
+    tracks, image = playlist
+    shots = [screenshot(image, scroll) for scroll in SCROLLS]
+    scroll_of = dict(zip(shots, SCROLLS))
+    crop_tops = []
+
+    # instead of tesseract, "read" the songs that are fully below the crop
+    def read_screenshot(image_source, crop_top=0):
+        crop_tops.append(crop_top)
+        return [list(track) for track in visible_tracks(tracks, scroll_of[image_source], crop_top)], []
+
+    monkeypatch.setattr(app, 'STITCH_SCREENSHOTS', True)
+    monkeypatch.setattr(app, 'OCR_WORKERS', 1)
+    monkeypatch.setattr(app, 'ocr_cache', app.ResultCache('ocr_cache', 100, 60))
+    monkeypatch.setattr(app, 'ocr_image_worker', read_screenshot)
+
+    assert app.extract_songs_parallel(shots) == [tuple(track) for track in tracks]
+    assert crop_tops[0] == 0 and all(top > 0 for top in crop_tops[1:])
+
+    # the same upload again comes from the cache, crop tops included
+    crop_tops.clear()
+    assert app.extract_songs_parallel(shots) == [tuple(track) for track in tracks]
+    assert crop_tops == []